@@ -0,0 +1,95 @@
+r"""
+Benchmarks the round-trip latency of the transports in :mod:`forsake.rpc`
+
+Each round-trip connects to the server, sends a payload that has the size of
+a typical spawn request and disconnects again, i.e., it does what a client
+does to spawn a process.
+
+Run with ``python -m benchmark.rpc [ROUNDS]``.
+"""
+
+# ********************************************************************
+#  This file is part of forsake
+#
+#        Copyright (C) 2023 Julian Rüth
+#
+#  forsake is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  forsake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with forsake. If not, see <https://www.gnu.org/licenses/>.
+# ********************************************************************
+
+import os
+import sys
+import time
+from tempfile import TemporaryDirectory
+
+import forsake.rpc
+from forsake.client import PluginClient
+from forsake.forker import context
+
+
+def serve(socket):
+    with forsake.rpc.Server(socket) as server:
+        server.register_function(lambda client, args: os.getpid(), "spawn")
+        server.serve_forever()
+
+
+def measure(client, socket, payload, rounds):
+    r"""
+    Return the sorted latencies in seconds of ``rounds`` spawn requests.
+    """
+    latencies = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        with client(socket) as remote:
+            remote.spawn(socket, payload)
+        latencies.append(time.perf_counter() - start)
+
+    return sorted(latencies)
+
+
+def main(rounds=1000):
+    from pickle import dumps
+
+    payload = dumps(
+        {
+            "exec": ("pass",),
+            **PluginClient.collect_cwd(),
+            **PluginClient.collect_env(),
+            **PluginClient.collect_stdio(),
+        }
+    )
+
+    with TemporaryDirectory() as sockdir:
+        socket = os.path.join(sockdir, "socket")
+
+        server = context.Process(target=serve, args=(socket,), daemon=True)
+        server.start()
+
+        while not os.path.exists(socket):
+            time.sleep(0.001)
+
+        print(f"payload: {len(payload)} bytes, rounds: {rounds}")
+        for name, client in [
+            ("xmlrpc", forsake.rpc.XMLRPCClient),
+            ("binary", forsake.rpc.Client),
+        ]:
+            latencies = measure(client, socket, payload, rounds)
+            p50 = latencies[len(latencies) // 2] * 1e6
+            p99 = latencies[len(latencies) * 99 // 100] * 1e6
+            print(f"{name:>8}: p50 {p50:8.1f}µs  p99 {p99:8.1f}µs")
+
+        server.kill()
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,330 @@
+r"""
+Measures how quickly forsake provides a usable process
+
+Run ``python -m benchmark.spawn --help`` for the available options. A summary
+is printed to stderr. The full results are printed to stdout as JSON so that
+they can be compared across releases.
+"""
+# ********************************************************************
+#  This file is part of forsake
+#
+#        Copyright (C) 2023 Julian Rüth
+#
+#  forsake is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  forsake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with forsake. If not, see <https://www.gnu.org/licenses/>.
+# ********************************************************************
+
+import os
+import sys
+import time
+from tempfile import TemporaryDirectory
+
+from forsake.cli import ExecServer
+from forsake.forker import context
+from forsake.protocol import Connection
+
+from test.client_server import ClientServer
+
+
+# A warmup that imports some modules and creates lots of objects that the
+# garbage collector tracks, like a real application would.
+WARMUP = """
+import decimal, email.parser, http.client, json, xml.dom.minidom
+data = [[i, str(i)] for i in range({objects})]
+"""
+
+
+class BenchmarkServer(ExecServer):
+    r"""
+    A server with a synthetic heavy warmup that can report to the benchmark
+    from its workers.
+    """
+
+    def __init__(self, socket, objects, **kwargs):
+        super().__init__(socket, WARMUP.format(objects=objects), **kwargs)
+
+        # Workers report how long it took them to start running.
+        self.latencies = context.SimpleQueue()
+
+        # Workers wait for this when asked to hold.
+        self.release = context.Event()
+
+    def warmup(self):
+        # Do not flood the output of the benchmark with the log of the server.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 2)
+        os.close(devnull)
+
+        super().warmup()
+
+    def startup_latency(self, sent):
+        self.latencies.put(time.monotonic() - sent)
+
+    def startup_hold(self):
+        # Behave like a worker that has been running for a while.
+        import gc
+
+        gc.collect()
+
+        self.release.wait()
+
+
+def spawn(socket, plugins):
+    r"""
+    Spawn a worker that runs ``plugins`` and return once it terminated.
+    """
+    connection = Connection.connect(socket)
+    try:
+        connection.call("spawn", {"exec": ("pass",), **plugins})
+        connection.receive()
+    finally:
+        connection.close()
+
+
+def percentiles(samples):
+    r"""
+    Return the p50 and p99 of ``samples``.
+    """
+    samples = sorted(samples)
+    return {
+        "p50": samples[len(samples) // 2],
+        "p99": samples[len(samples) * 99 // 100],
+        "n": len(samples),
+    }
+
+
+def measure_latency(server, socket, rounds):
+    r"""
+    Return the time from sending a request to the worker running its startup.
+    """
+    latencies = []
+    for _ in range(rounds):
+        spawn(socket, {"latency": (time.monotonic(),)})
+        latencies.append(server.latencies.get())
+
+    return percentiles(latencies)
+
+
+def measure_wall(socket, rounds):
+    r"""
+    Return the wall time of running ``forsake-client``, including the startup
+    of the Python interpreter.
+    """
+    import subprocess
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    with TemporaryDirectory() as tmp:
+        startup = os.path.join(tmp, "startup.py")
+        with open(startup, "w") as file:
+            file.write("pass")
+
+        command = [sys.executable, "-m", "forsake.fastclient"]
+        command += ["--socket", socket, "--startup", startup]
+
+        walls = []
+        for _ in range(rounds):
+            start = time.monotonic()
+            subprocess.run(
+                command,
+                cwd=root,
+                check=True,
+                stdin=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            walls.append(time.monotonic() - start)
+
+    return percentiles(walls)
+
+
+def measure_throughput(socket, clients, duration):
+    r"""
+    Return the number of workers spawned per second when ``clients`` clients
+    request workers at the same time for ``duration`` seconds.
+    """
+    import threading
+
+    spawned = [0] * clients
+    deadline = time.monotonic() + duration
+
+    def run(client):
+        while time.monotonic() < deadline:
+            spawn(socket, {})
+            spawned[client] += 1
+
+    start = time.monotonic()
+    threads = [
+        threading.Thread(target=run, args=(client,)) for client in range(clients)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return sum(spawned) / (time.monotonic() - start)
+
+
+def measure_memory(server, socket, workers):
+    r"""
+    Return the average memory usage in bytes of ``workers`` workers that are
+    running at the same time.
+    """
+    import threading
+
+    from forsake.rpc import Client
+
+    threads = [
+        threading.Thread(target=spawn, args=(socket, {"hold": ()}))
+        for _ in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+
+    with Client(socket) as proxy:
+        while True:
+            report = proxy.memory()
+            report.pop(server.pid, None)
+            if len(report) == workers:
+                break
+            time.sleep(0.01)
+
+    server.release.set()
+    for thread in threads:
+        thread.join()
+
+    return {
+        key: sum(usage[key] for usage in report.values()) // workers
+        for key in ["rss", "pss", "shared", "private"]
+    }
+
+
+def benchmark(args, freeze):
+    r"""
+    Run all benchmarks against a server and return the results.
+    """
+    from functools import partial
+
+    results = {}
+
+    with TemporaryDirectory() as tmp:
+        socket = os.path.join(tmp, "socket")
+
+        factory = partial(
+            BenchmarkServer,
+            objects=args.objects,
+            pool=(max(args.pool - 1, 0), args.pool) if args.pool else None,
+            concurrency=max(args.clients),
+            freeze=freeze,
+        )
+
+        with ClientServer().spawn_server(socket, server=factory) as process:
+            # The process is a fork, so this is a copy of the actual server
+            # that shares its queue and event with it.
+            server = process.server
+            server.pid = process.pid
+
+            results["latency"] = measure_latency(server, socket, args.rounds)
+            results["wall"] = measure_wall(socket, args.wall_rounds)
+            results["throughput"] = {
+                str(clients): measure_throughput(socket, clients, args.duration)
+                for clients in args.clients
+            }
+            results["memory"] = measure_memory(server, socket, args.workers)
+
+    return results
+
+
+def summarize(name, results):
+    def ms(seconds):
+        return f"{seconds * 1e3:7.2f}ms"
+
+    def mb(size):
+        return f"{size / 2**20:7.1f}MB"
+
+    lines = [f"{name}:"]
+    for key in ["latency", "wall"]:
+        result = results[key]
+        lines.append(f"  {key:>10}: p50 {ms(result['p50'])}  p99 {ms(result['p99'])}")
+    for clients, rate in results["throughput"].items():
+        lines.append(f"  {clients:>3} clients: {rate:7.1f} spawns/s")
+    memory = results["memory"]
+    lines.append(
+        "  per worker: "
+        + "  ".join(f"{key} {mb(memory[key])}" for key in ["rss", "pss", "private"])
+    )
+
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    import argparse
+    import json
+    import platform
+
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmark.spawn", description=__doc__.strip().split("\n")[0]
+    )
+    parser.add_argument(
+        "--rounds", type=int, default=200, help="requests to measure latency with"
+    )
+    parser.add_argument(
+        "--wall-rounds",
+        type=int,
+        default=20,
+        help="runs of forsake-client to measure wall time with",
+    )
+    parser.add_argument(
+        "--clients",
+        type=int,
+        nargs="+",
+        default=[1, 4, 16],
+        help="numbers of concurrent clients to measure throughput with",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=2,
+        help="seconds to measure throughput for each number of clients",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="workers to run at the same time to measure memory",
+    )
+    parser.add_argument(
+        "--objects", type=int, default=200000, help="size of the synthetic warmup"
+    )
+    parser.add_argument(
+        "--pool", type=int, default=0, help="size of the pool of the server"
+    )
+    args = parser.parse_args(argv)
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "options": vars(args),
+        "servers": {},
+    }
+
+    for name, freeze in [("default", False), ("freeze", True)]:
+        results["servers"][name] = benchmark(args, freeze)
+        print(summarize(name, results["servers"][name]), file=sys.stderr)
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+r"""
+Helpers to start a server when a client needs one.
+
+The first client that finds no server listening on the socket starts one in
+the background. Other clients that come at the same time wait for it
+instead of starting servers of their own. Together with an
+``idle_timeout`` of the server, a warm server is only around while it is
+being used.
+"""
+# ********************************************************************
+#  This file is part of forsake
+#
+#        Copyright (C) 2023 Julian Rüth
+#
+#  forsake is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  forsake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with forsake. If not, see <https://www.gnu.org/licenses/>.
+# ********************************************************************
+
+
+def listening(socket):
+    r"""
+    Return whether a server accepts connections on ``socket``, a Unix socket
+    or a ``tcp://HOST:PORT`` address.
+    """
+    import socket as sockets
+
+    from forsake.protocol import tcp
+
+    address = tcp(socket)
+    try:
+        if address is None:
+            with sockets.socket(sockets.AF_UNIX, sockets.SOCK_STREAM) as probe:
+                probe.connect(socket)
+        else:
+            sockets.create_connection(address).close()
+    except (FileNotFoundError, ConnectionRefusedError):
+        return False
+
+    return True
+
+
+def command(socket, warmup, idle_timeout=None):
+    r"""
+    Return the command line that runs ``forsake-server`` listening on
+    ``socket`` with the ``warmup`` file.
+    """
+    import os
+    import sys
+
+    args = [sys.executable, "-c", "from forsake.cli import server; server()"]
+    args += ["--socket", socket, "--warmup", os.path.abspath(warmup)]
+    if idle_timeout is not None:
+        args += ["--idle-timeout", str(idle_timeout)]
+
+    return args
+
+
+def activate(socket, args):
+    r"""
+    Make sure that a server is listening on ``socket``, starting one with
+    the command line ``args`` if there is none.
+
+    Returns once the server accepts connections. The server runs in the
+    background and logs to ``{socket}.log``.
+
+    Callers hold a lock on ``{socket}.lock`` while they start the server so
+    that only one of them starts it and the others wait for it. So this only
+    works for Unix sockets.
+    """
+    from forsake.protocol import tcp
+
+    if tcp(socket) is not None:
+        raise ValueError("servers can only be started for Unix sockets")
+
+    if listening(socket):
+        return
+
+    import fcntl
+    import os
+    import subprocess
+    import time
+
+    with open(f"{socket}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        # Somebody else started the server while we waited for the lock.
+        if listening(socket):
+            return
+
+        # A server that crashed might have left its socket behind.
+        try:
+            os.unlink(socket)
+        except FileNotFoundError:
+            pass
+
+        with open(f"{socket}.log", "ab") as log:
+            server = subprocess.Popen(
+                args,
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=log,
+                # The server outlives us and must not get our signals.
+                start_new_session=True,
+            )
+
+        while not listening(socket):
+            if server.poll() is not None:
+                raise RuntimeError(
+                    f"server exited with code {server.returncode} before listening on {socket}, see {socket}.log"
+                )
+            time.sleep(0.01)
@@ -0,0 +1,139 @@
+# ********************************************************************
+#  This file is part of forsake
+#
+#        Copyright (C) 2023 Julian Rüth
+#
+#  forsake is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  forsake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with forsake. If not, see <https://www.gnu.org/licenses/>.
+# ********************************************************************
+
+import threading
+import time
+
+
+class Admission:
+    r"""
+    Limits the number of workers that run at the same time to
+    ``max_workers``.
+
+    Requests for more workers wait until a worker terminates. If there are
+    already ``max_queue`` requests waiting, further requests are rejected.
+    If ``max_workers`` is ``None``, workers are only counted, see
+    :meth:`idle`.
+
+    Workers might be reaped by images instead of the server. Such images
+    cannot update this object since it lives in the server, so they
+    :meth:`release` by sending a datagram that the server collects in a
+    background thread.
+    """
+
+    def __init__(self, max_workers, max_queue=None):
+        import os
+        import socket
+
+        if max_workers is not None and max_workers < 1:
+            raise ValueError("max_workers must be positive")
+        if max_queue is not None and max_queue < 0:
+            raise ValueError("max_queue must not be negative")
+
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.running = 0
+        self.queued = 0
+
+        self._condition = threading.Condition()
+        self._idle_since = time.monotonic()
+        self._pid = os.getpid()
+        self._releases, self._releaser = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_DGRAM
+        )
+
+    def start(self):
+        r"""
+        Start collecting the releases sent by images in a background thread.
+        """
+        threading.Thread(target=self._receive, daemon=True).start()
+
+    def _receive(self):
+        while True:
+            self._releases.recv(1)
+            self._release()
+
+    def acquire(self):
+        r"""
+        Wait until another worker may run and return how long that took.
+
+        Raises a ``RuntimeError`` if too many requests are waiting already.
+        """
+        start = time.monotonic()
+        with self._condition:
+            if self._full():
+                if self.max_queue is not None and self.queued >= self.max_queue:
+                    raise RuntimeError(
+                        f"server is busy: {self.running} workers are running and {self.queued} requests are waiting"
+                    )
+
+                self.queued += 1
+                try:
+                    while self._full():
+                        self._condition.wait()
+                finally:
+                    self.queued -= 1
+
+            self.running += 1
+
+        return time.monotonic() - start
+
+    def _full(self):
+        return self.max_workers is not None and self.running >= self.max_workers
+
+    def release(self):
+        r"""
+        Record that a worker terminated.
+        """
+        import os
+
+        if os.getpid() == self._pid:
+            self._release()
+        else:
+            self._releaser.send(b"\0")
+
+    def _release(self):
+        with self._condition:
+            self.running -= 1
+            if not self.running:
+                self._idle_since = time.monotonic()
+            self._condition.notify()
+
+    def idle(self):
+        r"""
+        Return for how many seconds no worker has been running.
+        """
+        with self._condition:
+            if self.running:
+                return 0
+
+            return time.monotonic() - self._idle_since
+
+    def load(self):
+        r"""
+        Return the number of running workers and of waiting requests together
+        with their limits.
+        """
+        with self._condition:
+            return {
+                "running": self.running,
+                "max_workers": self.max_workers,
+                "queued": self.queued,
+                "max_queue": self.max_queue,
+            }
@@ -0,0 +1,213 @@
+r"""
+A registry of large read-only data that workers share with the server.
+
+Tables that are loaded as Python objects during warmup do not stay shared
+for long: every time a worker touches one of these objects, it writes to its
+reference count and the page holding it is copied. Data that is registered
+here instead lives in read-only memory maps outside of the Python heap, so
+forked workers read the very same pages as the server::
+
+    from forsake.assets import register
+
+    def warmup():
+        register("primes", "primes.bin")
+        register("weights", "weights.npy")
+
+and in the worker::
+
+    from forsake.assets import get
+
+    get("primes")[:8]
+
+Run ``forsake-memory --socket …`` to see how much memory the assets save.
+"""
+# ********************************************************************
+#  This file is part of forsake
+#
+#        Copyright (C) 2023 Julian Rüth
+#
+#  forsake is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  forsake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with forsake. If not, see <https://www.gnu.org/licenses/>.
+# ********************************************************************
+
+# The registered assets by name.
+_assets = {}
+
+
+class _Asset:
+    def __init__(self, value, path, size):
+        import os
+
+        self.value = value
+
+        # The file that is mapped as it shows up in /proc/<pid>/smaps.
+        self.path = path
+
+        self.size = size
+
+        # Only the process that registered the asset reports its usage, see
+        # usage().
+        self.owner = os.getpid()
+
+
+def register(name, source, dtype=None, shape=None, preload=True):
+    r"""
+    Map ``source`` read-only into memory, make it available as ``name`` and
+    return it.
+
+    If ``source`` is a path, that file is mapped. NumPy's ``.npy`` files are
+    returned as read-only arrays. Otherwise, ``source`` must support the
+    buffer protocol, e.g., ``bytes``. Its data is copied into an anonymous
+    memory file that is then mapped.
+
+    The asset is returned as a read-only ``memoryview`` or, if a ``dtype``
+    is given, as a read-only numpy array of that ``dtype`` and ``shape``.
+
+    With ``preload``, the kernel is asked to read the data right away so
+    that workers do not have to wait for it.
+    """
+    import mmap
+    import os
+
+    if name in _assets:
+        raise ValueError(f"asset {name} has already been registered")
+
+    if isinstance(source, (str, os.PathLike)):
+        path = os.path.realpath(source)
+
+        if path.endswith(".npy") and dtype is None:
+            import numpy
+
+            value = numpy.load(path, mmap_mode="r")
+            _assets[name] = _Asset(value, path, value.nbytes)
+            return value
+
+        fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    else:
+        from forsake.buffers import _memfd
+
+        data = memoryview(source).cast("B")
+        fd = _memfd(data.nbytes, f"forsake:{name}")
+        try:
+            os.pwrite(fd, data, 0)
+        except BaseException:
+            os.close(fd)
+            raise
+
+        path = os.readlink(f"/proc/self/fd/{fd}") if os.path.exists("/proc") else None
+
+    try:
+        size = os.fstat(fd).st_size
+        memory = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+
+    if preload and hasattr(mmap, "MADV_WILLNEED"):
+        memory.madvise(mmap.MADV_WILLNEED)
+
+    value = memoryview(memory)
+
+    if dtype is not None:
+        import numpy
+
+        value = numpy.frombuffer(value, dtype=dtype)
+        if shape is not None:
+            value = value.reshape(shape)
+
+    _assets[name] = _Asset(value, path, size)
+    return value
+
+
+def get(name):
+    r"""
+    Return the asset that was registered as ``name``.
+    """
+    try:
+        return _assets[name].value
+    except KeyError:
+        raise KeyError(f"no asset {name} has been registered") from None
+
+
+def registered():
+    r"""
+    Return the names of the assets that have been registered.
+    """
+    return list(_assets)
+
+
+def usage(pids):
+    r"""
+    Return how much memory the assets registered by this process use in the
+    processes ``pids``.
+
+    Returns a dict mapping the name of each asset to its ``size`` and the
+    ``rss`` and ``pss`` summed over the processes as read from
+    ``/proc/<pid>/smaps``. The memory that sharing ``saved`` is the
+    difference: what the processes would use with copies of their own.
+
+    Assets are not reported when this information is not available, e.g.,
+    because this is not Linux.
+    """
+    import os
+
+    assets = {
+        asset.path: name
+        for name, asset in _assets.items()
+        if asset.owner == os.getpid() and asset.path is not None
+    }
+
+    report = {}
+    for pid in pids:
+        for path, pages in _mapped(pid, assets).items():
+            name = assets[path]
+            if name not in report:
+                report[name] = {"size": _assets[name].size, "rss": 0, "pss": 0}
+            report[name]["rss"] += pages["rss"]
+            report[name]["pss"] += pages["pss"]
+
+    for usage in report.values():
+        usage["saved"] = usage["rss"] - usage["pss"]
+
+    return report
+
+
+def _mapped(pid, paths):
+    r"""
+    Return the resident and proportional set size of the mappings of the
+    files ``paths`` in the process ``pid``.
+    """
+    mapped = {}
+    path = None
+
+    try:
+        with open(f"/proc/{pid}/smaps") as smaps:
+            for line in smaps:
+                key, _, value = line.partition(":")
+                if " " in key:
+                    # A header line "address perms offset dev inode path" that
+                    # starts a new mapping.
+                    fields = line.split(maxsplit=5)
+                    path = fields[5].rstrip("\n") if len(fields) == 6 else None
+                    if path not in paths and path is not None:
+                        # The file might have been removed after it was mapped.
+                        path = path.removesuffix(" (deleted)")
+                    if path not in paths:
+                        path = None
+                    elif path not in mapped:
+                        mapped[path] = {"rss": 0, "pss": 0}
+                elif path is not None and key in ("Rss", "Pss"):
+                    mapped[path][key.lower()] += int(value.split()[0]) * 1024
+    except OSError:
+        return {}
+
+    return mapped
@@ -0,0 +1,109 @@
+r"""
+Spreads requests over several servers.
+
+A :class:`Balancer` asks each server for its :meth:`forsake.server.Server.load`
+and picks the one with the most room. Servers can listen on Unix sockets or
+on TCP addresses of other machines, so a farm of warm servers can serve
+clients from many machines.
+"""
+# ********************************************************************
+#  This file is part of forsake
+#
+#        Copyright (C) 2023 Julian Rüth
+#
+#  forsake is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  forsake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with forsake. If not, see <https://www.gnu.org/licenses/>.
+# ********************************************************************
+
+import threading
+import time
+
+
+class Balancer:
+    r"""
+    Chooses which of the servers listening on ``sockets`` should fork the
+    next process.
+
+    The load of each server is queried over a new connection that is closed
+    right after. A server that handles one connection at a time would serve
+    nobody else while we kept a connection open. Servers that cannot be
+    reached are skipped for ``retry`` seconds.
+    """
+
+    def __init__(self, sockets, retry=1):
+        if not sockets:
+            raise ValueError("need at least one server")
+
+        self._sockets = list(sockets)
+        self._retry = retry
+
+        # When each of the unreachable servers can be tried again.
+        self._unreachable = {}
+
+        # Breaks ties between equally loaded servers in turn.
+        self._turn = 0
+
+        self._lock = threading.Lock()
+
+    def choose(self):
+        r"""
+        Return the socket of the server with the least load.
+
+        Raises a ``ConnectionError`` if none of the servers can be reached.
+        """
+        with self._lock:
+            self._turn += 1
+            turn = self._turn
+
+        best = None
+        for position, socket in enumerate(self._sockets):
+            load = self.load(socket)
+            if load is None:
+                continue
+
+            rank = (load, (position - turn) % len(self._sockets))
+            if best is None or rank < best[0]:
+                best = (rank, socket)
+
+        if best is None:
+            raise ConnectionError("none of the servers can be reached")
+
+        return best[1]
+
+    def load(self, socket):
+        r"""
+        Return the load of the server listening on ``socket`` or ``None`` if
+        it cannot be reached.
+
+        The load is the number of running and waiting workers relative to
+        the number of workers the server may run at the same time. Servers
+        that do not report their load are considered idle.
+        """
+        from forsake.rpc import Client
+
+        with self._lock:
+            if self._unreachable.get(socket, 0) > time.monotonic():
+                return None
+
+        try:
+            with Client(socket) as client:
+                load = client.load()
+        except (OSError, EOFError):
+            with self._lock:
+                self._unreachable[socket] = time.monotonic() + self._retry
+            return None
+
+        if load is None:
+            return 0
+
+        return (load["running"] + load["queued"]) / (load["max_workers"] or 1)
@@ -0,0 +1,133 @@
+r"""
+Helpers to send large buffers between processes through shared memory.
+
+Objects are pickled with protocol 5, see PEP 574. Large buffers that support
+out-of-band pickling, such as the data of numpy arrays, are not copied into
+the pickle but into a single memory file. The receiver maps that file and
+the unpickled objects use the mapped memory directly.
+"""
+# ********************************************************************
+#  This file is part of forsake
+#
+#        Copyright (C) 2023 Julian Rüth
+#
+#  forsake is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  forsake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with forsake. If not, see <https://www.gnu.org/licenses/>.
+# ********************************************************************
+
+# Buffers smaller than this are cheaper to copy into the pickle.
+THRESHOLD = 1 << 16
+
+# Buffers start at multiples of this in the memory file so that arrays built
+# on top of them are aligned.
+ALIGNMENT = 64
+
+
+def dumps(obj):
+    r"""
+    Return ``obj`` pickled as a triple ``(data, layout, fd)``.
+
+    The large buffers of ``obj`` are in the memory file ``fd`` at the offsets
+    and sizes given by ``layout``. If there are no such buffers, ``fd`` is
+    ``None``. Otherwise, the caller must close ``fd``.
+    """
+    import mmap
+    import pickle
+
+    buffers = []
+
+    def out_of_band(buffer):
+        try:
+            size = buffer.raw().nbytes
+        except BufferError:
+            # Buffers that are not contiguous cannot be sent out of band.
+            return True
+
+        if size < THRESHOLD:
+            return True
+
+        buffers.append(buffer)
+        return False
+
+    data = pickle.dumps(obj, protocol=5, buffer_callback=out_of_band)
+
+    if not buffers:
+        return data, [], None
+
+    layout = []
+    size = 0
+    for buffer in buffers:
+        offset = -(-size // ALIGNMENT) * ALIGNMENT
+        size = offset + buffer.raw().nbytes
+        layout.append((offset, buffer.raw().nbytes))
+
+    fd = _memfd(size)
+    try:
+        with mmap.mmap(fd, size) as memory:
+            for (offset, length), buffer in zip(layout, buffers):
+                memory[offset : offset + length] = buffer.raw()
+    except BaseException:
+        import os
+
+        os.close(fd)
+        raise
+
+    return data, layout, fd
+
+
+def loads(data, layout, fd):
+    r"""
+    Return the object pickled by :func:`dumps`.
+
+    Takes ownership of ``fd``. The buffers of the returned object map the
+    memory file copy-on-write, so they can be modified without affecting
+    anybody else.
+    """
+    import os
+    import pickle
+
+    if fd is None:
+        return pickle.loads(data)
+
+    try:
+        import mmap
+
+        memory = mmap.mmap(fd, os.fstat(fd).st_size, access=mmap.ACCESS_COPY)
+    finally:
+        os.close(fd)
+
+    view = memoryview(memory)
+    return pickle.loads(
+        data, buffers=[view[offset : offset + length] for offset, length in layout]
+    )
+
+
+def _memfd(size, name="forsake"):
+    r"""
+    Return a file descriptor of an anonymous file of ``size`` bytes.
+
+    Where supported, the file shows up as ``/memfd:{name}`` in
+    ``/proc/<pid>/maps``.
+    """
+    import os
+
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create(name, os.MFD_CLOEXEC)
+    else:
+        import tempfile
+
+        with tempfile.TemporaryFile() as file:
+            fd = os.dup(file.fileno())
+
+    os.ftruncate(fd, size)
+    return fd
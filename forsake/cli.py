@@ -24,45 +24,515 @@ from forsake.client import PluginClient
 
 
 @click.command()
-@click.option("--socket", required=True, type=click.Path(exists=False))
+@click.option(
+    "--socket",
+    required=True,
+    type=click.Path(exists=False),
+    help="the Unix socket to listen on or tcp://HOST:PORT to accept clients from other machines",
+)
 @click.option("--warmup", required=True, type=click.File("r"))
-def server(socket, warmup):
-    server = ExecServer(socket, warmup.read())
+@click.option(
+    "--pool",
+    default=0,
+    type=int,
+    help="number of workers to fork before clients request them",
+)
+@click.option(
+    "--pool-low",
+    default=None,
+    type=int,
+    help="fork more workers when no more than this many are left [default: POOL - 1]",
+)
+@click.option(
+    "--concurrency",
+    default=1,
+    type=click.IntRange(min=1),
+    help="number of requests to handle at the same time",
+)
+@click.option(
+    "--freeze/--no-freeze",
+    default=False,
+    help="exclude the objects created during warmup from garbage collection so forked processes share more memory with the server",
+)
+@click.option(
+    "--stats/--no-stats",
+    default=False,
+    help="record how long the phases of spawning a worker take",
+)
+@click.option(
+    "--stats-interval",
+    default=None,
+    type=click.FloatRange(min=0, min_open=True),
+    help="log statistics about spawning every this many seconds (implies --stats)",
+)
+@click.option(
+    "--image",
+    "images",
+    multiple=True,
+    metavar="NAME[:PARENT]=FILE",
+    help="an image that runs FILE after the warmup or after the warmup of the image PARENT; started when a client first requests NAME",
+)
+@click.option(
+    "--max-images",
+    default=None,
+    type=click.IntRange(min=1),
+    help="terminate the least recently used images when more are running",
+)
+@click.option(
+    "--max-image-memory",
+    default=None,
+    type=click.IntRange(min=0),
+    help="terminate the least recently used images when they use more bytes of memory (PSS)",
+)
+@click.option(
+    "--reload/--no-reload",
+    default=False,
+    help="when modules imported during warmup change, warm up again in the background and fork new processes from there",
+)
+@click.option(
+    "--reload-interval",
+    default=1,
+    type=click.FloatRange(min=0, min_open=True),
+    help="check for changed modules every this many seconds",
+)
+@click.option(
+    "--max-workers",
+    default=None,
+    type=click.IntRange(min=1),
+    help="number of workers that may run at the same time; further requests wait",
+)
+@click.option(
+    "--max-queue",
+    default=None,
+    type=click.IntRange(min=0),
+    help="number of requests that may wait for a worker; further requests are rejected (requires --max-workers and --concurrency > 1)",
+)
+@click.option(
+    "--limit",
+    "limits",
+    multiple=True,
+    metavar="NAME=VALUE",
+    help="a resource limit for workers such as cpu=60 (seconds) or as=1000000000 (bytes of address space), see RLIMIT_* in resource",
+)
+@click.option(
+    "--cgroup",
+    default=None,
+    type=click.Path(exists=True, file_okay=False),
+    help="the cgroup directory to move workers into",
+)
+@click.option(
+    "--timeout",
+    default=None,
+    type=click.FloatRange(min=0, min_open=True),
+    help="stop workers that run for more than this many seconds",
+)
+@click.option(
+    "--cpu-timeout",
+    default=None,
+    type=click.FloatRange(min=0, min_open=True),
+    help="stop workers that use more than this many seconds of CPU time",
+)
+@click.option(
+    "--grace",
+    default=(1, 1),
+    nargs=2,
+    type=click.FloatRange(min=0),
+    show_default=True,
+    metavar="INT TERM",
+    help="seconds to wait after SIGINT before sending SIGTERM and after SIGTERM before sending SIGKILL when stopping a worker",
+)
+@click.option(
+    "--idle-timeout",
+    default=None,
+    type=click.FloatRange(min=0, min_open=True),
+    help="remove the socket and exit once no worker has been running for this many seconds",
+)
+@click.option(
+    "--imports/--no-imports",
+    default=False,
+    help="record which modules workers import after they have been forked",
+)
+@click.option(
+    "--promote-imports",
+    default=None,
+    type=click.IntRange(min=1),
+    help="import modules into the warmup once this many workers had to import them (implies --imports)",
+)
+def server(
+    socket,
+    warmup,
+    pool,
+    pool_low,
+    concurrency,
+    freeze,
+    stats,
+    stats_interval,
+    images,
+    max_images,
+    max_image_memory,
+    reload,
+    reload_interval,
+    max_workers,
+    max_queue,
+    limits,
+    cgroup,
+    timeout,
+    cpu_timeout,
+    grace,
+    idle_timeout,
+    imports,
+    promote_imports,
+):
+    if pool_low is None:
+        pool_low = max(pool - 1, 0)
+
+    warmups = {}
+    parents = {}
+    for image in images:
+        name, equals, path = image.partition("=")
+        name, colon, parent = name.partition(":")
+        if not equals or not name or (colon and not parent):
+            raise click.BadParameter(
+                f"{image!r} is not of the form NAME[:PARENT]=FILE",
+                param_hint="--image",
+            )
+        with open(path) as file:
+            warmups[name] = file.read()
+        if parent:
+            parents[name] = parent
+
+    resources = {}
+    for limit in limits:
+        name, equals, value = limit.partition("=")
+        try:
+            resources[name] = int(value)
+        except ValueError:
+            equals = None
+        if not equals or not name:
+            raise click.BadParameter(
+                f"{limit!r} is not of the form NAME=VALUE", param_hint="--limit"
+            )
+
+    server = ExecServer(
+        socket,
+        warmup.read(),
+        images=warmups,
+        parents=parents,
+        max_images=max_images,
+        max_image_memory=max_image_memory,
+        reload=reload,
+        reload_interval=reload_interval,
+        max_workers=max_workers,
+        max_queue=max_queue,
+        limits=resources,
+        cgroup=cgroup,
+        timeout=timeout,
+        cpu_timeout=cpu_timeout,
+        grace=grace,
+        idle_timeout=idle_timeout,
+        imports=imports,
+        promote_imports=promote_imports,
+        pool=(pool_low, pool) if pool else None,
+        concurrency=concurrency,
+        freeze=freeze,
+        stats=stats,
+        stats_interval=stats_interval,
+    )
     try:
         server.start()
-    finally:
-        import os
+    except BaseException:
+        # When start() returns, the server was idle and removed its socket
+        # already. Another server might be using that path by now.
+        from forsake.protocol import tcp
+
+        if tcp(socket) is None:
+            import os
 
-        os.unlink(socket)
+            os.unlink(socket)
+        raise
 
 
 @click.command()
-@click.option("--socket", required=True, type=click.Path(exists=True))
+@click.option(
+    "--socket",
+    required=True,
+    help="the socket the server is listening on, tcp://HOST:PORT for a server on another machine, or a comma-separated list of these to pick the least loaded",
+)
 @click.option("--startup", required=True, type=click.File("r"))
-def client(socket, startup):
-    client = PluginClient(socket)
-    client.start(
-        {
-            "exec": (startup.read(),),
+@click.option("--image", default=None, help="the image of the server to fork from")
+@click.option(
+    "--send",
+    default="source",
+    type=click.Choice(["source", "path"]),
+    show_default=True,
+    help="send the code in FILE or only its path so the server can reuse the compiled code",
+)
+@click.option(
+    "--pty/--no-pty",
+    default=False,
+    help="run the process in a pseudo-terminal for interactive sessions",
+)
+@click.option(
+    "--timeout",
+    default=None,
+    type=click.FloatRange(min=0, min_open=True),
+    help="make the server stop the process after this many seconds",
+)
+@click.option(
+    "--cpu-timeout",
+    default=None,
+    type=click.FloatRange(min=0, min_open=True),
+    help="make the server stop the process after this many seconds of CPU time",
+)
+@click.option(
+    "--warmup",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="start a server with this warmup if none is listening on the socket",
+)
+@click.option(
+    "--idle-timeout",
+    default=300,
+    type=click.FloatRange(min=0, min_open=True),
+    show_default=True,
+    help="make a server started with --warmup exit after being idle for this many seconds",
+)
+def client(
+    socket, startup, image, send, pty, timeout, cpu_timeout, warmup, idle_timeout
+):
+    import os.path
+
+    from forsake.protocol import tcp
+
+    sockets = socket.split(",")
+    remote = any(tcp(socket) is not None for socket in sockets)
+
+    if warmup is not None:
+        if len(sockets) != 1 or remote:
+            raise click.BadParameter(
+                "requires a single Unix socket", param_hint="'--warmup'"
+            )
+
+        from forsake.activation import activate, command
+
+        activate(socket, command(socket, warmup, idle_timeout))
+    else:
+        for socket in sockets:
+            if tcp(socket) is None and not os.path.exists(socket):
+                raise click.BadParameter(
+                    f"Path {socket!r} does not exist.", param_hint="'--socket'"
+                )
+
+    if pty and remote:
+        raise click.BadParameter(
+            "cannot be used with a server on another machine", param_hint="'--pty'"
+        )
+
+    if send == "path":
+        startup = {"script": (os.path.abspath(startup.name),)}
+    else:
+        startup = {"exec": (startup.read(),)}
+
+    socket = sockets[0]
+    if len(sockets) > 1:
+        from forsake.balancer import Balancer
+
+        socket = Balancer(sockets).choose()
+
+    client = PluginClient(socket, image=image)
+
+    if tcp(socket) is not None:
+        # The server cannot reach our streams, and our working directory and
+        # environment might not make sense on its machine.
+        plugins = client.collect_stream()
+    else:
+        plugins = {
             **client.collect_cwd(),
             **client.collect_env(),
-            **client.collect_stdio(),
+            **(client.collect_pty() if pty else client.collect_stdio()),
         }
+
+    client.start(
+        {**startup, **plugins, **client.collect_deadline(timeout, cpu_timeout)}
+    )
+
+
+@click.command()
+@click.option("--socket", required=True, type=click.Path(exists=True))
+def memory(socket):
+    r"""
+    Print how much memory the server and its workers use and how much the
+    shared assets save, see :mod:`forsake.assets`.
+    """
+    from forsake.rpc import Client
+
+    with Client(socket) as server:
+        report = server.memory()
+        assets = server.assets()
+
+    click.echo(f"{'PID':>8} {'RSS':>10} {'PSS':>10} {'SHARED':>10} {'PRIVATE':>10}")
+    for pid, usage in sorted(report.items()):
+        click.echo(
+            f"{pid:>8} "
+            + " ".join(
+                f"{usage[key] // 1024:>8}kB"
+                for key in ["rss", "pss", "shared", "private"]
+            )
+        )
+
+    if assets:
+        click.echo()
+        click.echo(f"{'ASSET':<16} {'SIZE':>10} {'RSS':>10} {'PSS':>10} {'SAVED':>10}")
+        for name, usage in sorted(assets.items()):
+            click.echo(
+                f"{name:<16} "
+                + " ".join(
+                    f"{usage[key] // 1024:>8}kB"
+                    for key in ["size", "rss", "pss", "saved"]
+                )
+            )
+
+
+@click.command()
+@click.option("--socket", required=True, type=click.Path(exists=True))
+def stats(socket):
+    r"""
+    Print how long the phases of spawning workers took on the server and
+    which modules workers had to import after they were forked.
+    """
+    from forsake.rpc import Client
+
+    with Client(socket) as server:
+        report = server.stats()
+        load = server.load()
+        imports = server.imports()
+
+    if load is not None:
+        max_workers = (
+            "unlimited" if load["max_workers"] is None else load["max_workers"]
+        )
+        max_queue = "unlimited" if load["max_queue"] is None else load["max_queue"]
+        click.echo(
+            f"workers {load['running']}/{max_workers}, queued {load['queued']}/{max_queue}"
+        )
+
+    click.echo(
+        f"{'PHASE':<16} {'COUNT':>8} {'P50':>10} {'P90':>10} {'P99':>10} {'MAX':>10}"
     )
+    for phase, stats in sorted(report.items()):
+        click.echo(
+            f"{phase:<16} {stats['count']:>8} "
+            + " ".join(
+                f"{stats[key] * 1e3:>8.3f}ms" for key in ["p50", "p90", "p99", "max"]
+            )
+        )
+
+    if imports:
+        # The modules that cost workers the most time first.
+        click.echo()
+        click.echo(f"{'IMPORTED MODULE':<32} {'COUNT':>8} {'SPAWNS':>8} {'MEAN':>10}")
+        for module, stats in sorted(imports.items(), key=lambda item: -item[1]["sum"]):
+            click.echo(
+                f"{module:<32} {stats['count']:>8} {stats['spawns']:>8} "
+                f"{stats['sum'] / stats['count'] * 1e3:>8.3f}ms"
+            )
 
 
 class ExecServer(PluginServer):
-    def __init__(self, socket, warmup):
-        super().__init__(socket)
+    r"""
+    A server that runs the code sent by clients in its workers.
+
+    The server keeps up to ``cache`` compiled scripts. Scripts are compiled
+    in the server before forking, see :meth:`prepare`, so that the workers
+    inherit the compiled code and do not have to compile it again.
+    """
+
+    def __init__(
+        self, socket, warmup, images=None, parents=None, cache=128, **kwargs
+    ):
+        super().__init__(socket, **kwargs)
+
+        import collections
 
         self._warmup = warmup
+        self._warmups = images or {}
+        self._parents = parents or {}
+        self._code = None
+        self._cache = cache
+        self._compiled = collections.OrderedDict()
 
     def startup(self, parameters):
         super().startup(parameters)
-        exec(self._code, globals(), globals())
+        if self._code is not None:
+            exec(self._code, globals(), globals())
+
+    def prepare_exec(self, code):
+        self._compile(("exec", code), None, lambda: code, "<startup>")
 
     def startup_exec(self, code):
-        self._code = code
+        self._code = self._compile(("exec", code), None, lambda: code, "<startup>")
+
+    def prepare_script(self, path):
+        self._script(path)
+
+    def startup_script(self, path):
+        r"""
+        Run the Python file at ``path``.
+        """
+        self._code = self._script(path)
+
+    def _script(self, path):
+        import os
+
+        def read():
+            with open(path) as file:
+                return file.read()
+
+        stat = os.stat(path)
+        return self._compile(
+            ("script", path), (stat.st_mtime_ns, stat.st_size), read, path
+        )
+
+    def _compile(self, key, stamp, read, filename):
+        r"""
+        Return the code that ``read()`` returns compiled as ``filename``.
+
+        The compiled code is cached as ``key`` and valid as long as ``stamp``
+        does not change.
+        """
+        # Requests are prepared concurrently but we cannot use a lock here
+        # since it might be held by another thread when a worker is forked.
+        # We only rely on each operation on the cache being atomic.
+        cached = self._compiled.get(key)
+        if cached is not None and cached[0] == stamp:
+            try:
+                self._compiled.move_to_end(key)
+            except KeyError:
+                pass
+            return cached[1]
+
+        code = compile(read(), filename, "exec")
+
+        self._compiled[key] = (stamp, code)
+        while len(self._compiled) > self._cache:
+            try:
+                self._compiled.popitem(last=False)
+            except KeyError:
+                break
+
+        return code
 
     def warmup(self):
         exec(self._warmup, globals(), globals())
+
+    def images(self):
+        return list(self._warmups)
+
+    def warm(self, image):
+        exec(self._warmups[image], globals(), globals())
+
+    def parent(self, image):
+        return self._parents.get(image)
+
+    def layer(self, image):
+        return self._warmups[image]
@@ -17,45 +17,75 @@
 #  along with forsake. If not, see <https://www.gnu.org/licenses/>.
 # ********************************************************************
 
-import contextlib
-import forsake.rpc
+from forsake.protocol import Connection
 
 
 class Client:
-    def __init__(self, socket):
+    r"""
+    Requests a process from the server listening on ``socket``.
+
+    If ``image`` is set, the process is forked from that image of the server
+    instead of the server itself.
+    """
+
+    def __init__(self, socket, image=None):
         self._socket = socket
-        self._server = None
+        self._image = image
+        self._connection = None
         self._exitcode = None
         self.pid = None
 
-    def start(self, args=None):
+    def start(self, args=None, fds=()):
         r"""
         Connect to the server.
 
+        The file descriptors ``fds`` are sent along with the request so that
+        the forked process can use them.
+
         This method blocks until the server signals to us that the forked
         process has terminated.
         """
-        with self._create_client() as remote:
-            with self._create_server() as socket:
-                self._request_fork(remote, socket, args)
-                self._handle_signals()
-                self._join()
+        self._connection = Connection.connect(self._socket)
+        try:
+            self._request_fork(self._connection, args, fds)
+            self._handle_signals()
+            self._join()
+        finally:
+            self._connection.close()
 
         import sys
 
         sys.exit(self._exitcode)
 
     def interrupt(self):
-        import signal
+        from _signal import SIGINT
 
-        self.signal(signal.SIGINT)
+        self.signal(SIGINT)
 
     def kill(self):
-        import signal
+        from _signal import SIGKILL
 
-        self.signal(signal.SIKILL)
+        self.signal(SIGKILL)
+
+    def cancel(self):
+        r"""
+        Make the server stop the forked process, first gently, then
+        forcefully, see :meth:`forsake.server.Server.cancel`.
+        """
+        connection = Connection.connect(self._socket)
+        try:
+            return connection.call("cancel", self.pid)
+        finally:
+            connection.close()
 
     def signal(self, signal):
+        from forsake.protocol import tcp
+
+        if tcp(self._socket) is not None:
+            raise ValueError(
+                "cannot signal a process on another machine, use a streaming PluginClient instead"
+            )
+
         import os
 
         os.kill(self.pid, signal)
@@ -63,63 +93,339 @@ class Client:
     def on_exit(self, exitcode):
         self._exitcode = exitcode
 
-        from threading import Thread
+    def on_timeout(self, exitcode):
+        r"""
+        Called instead of :meth:`on_exit` when the server stopped the forked
+        process because it exceeded its deadline.
+        """
+        from sys import stderr
 
-        Thread(target=self._server.shutdown).start()
+        print(f"Process with PID {self.pid} timed out", file=stderr, flush=True)
 
-    @contextlib.contextmanager
-    def _create_client(self):
-        with forsake.rpc.Client(self._socket) as remote:
-            yield remote
+        # Exit like the timeout command does.
+        self.on_exit(124)
 
-    @contextlib.contextmanager
-    def _create_server(self):
-        from tempfile import TemporaryDirectory
+    def _request_fork(self, connection, args, fds=()):
+        if self._image is None:
+            self.pid = connection.call("spawn", args, fds=fds)
+        else:
+            self.pid = connection.call("spawn_image", self._image, args, fds=fds)
 
-        with TemporaryDirectory() as sockdir:
-            import os.path
+        from sys import stderr
 
-            socket = os.path.join(sockdir, "socket")
+        print(f"Attached to process with PID {self.pid}", file=stderr, flush=True)
 
-            with forsake.rpc.Server(socket) as server:
-                self._server = server
+    def _handle_signals(self):
+        # Importing signal would also import enum which takes several
+        # milliseconds.
+        import _signal
 
-                server.register_function(self.on_exit, "exit")
+        _signal.signal(_signal.SIGINT, lambda *args: self.interrupt())
 
-                yield socket
+    def _join(self):
+        # The server reports the exit code on the same connection once the
+        # forked process has terminated.
+        kind, exitcode = self._connection.receive()
+        if kind == "timeout":
+            self.on_timeout(exitcode)
+        else:
+            self.on_exit(exitcode)
 
-    def _request_fork(self, remote, socket, args):
-        self.pid = remote.spawn(socket, args)
 
-        from sys import stderr
+class PluginClient(Client):
+    # The controlling side of the pseudo-terminal of the forked process and
+    # our copy of its terminal side, see collect_pty().
+    _pty = None
+    _terminal = None
 
-        print(f"Attached to process with PID {self.pid}", file=stderr, flush=True)
+    # The pipe to wake up the relay of a streaming client when it should
+    # signal the forked process, see collect_stream().
+    _signals = None
+
+    def start(self, plugins=None):
+        fds = self.collect_fds(plugins)
+
+        if plugins and "stream" in plugins:
+            import os
+
+            if "stdio" in plugins or "pty" in plugins:
+                raise ValueError("cannot stream stdio and connect it at the same time")
+
+            self._signals = os.pipe()
+
+        if plugins and "pty" in plugins:
+            import os
+
+            if "stdio" in plugins:
+                raise ValueError("cannot connect stdio when using a pty")
+
+            self._pty, self._terminal = os.openpty()
+            self._resize()
+            fds = (self._terminal, *fds)
+
+        if plugins and "env" in plugins and len(plugins["env"]) == 1:
+            plugins = {**plugins, "env": self.compress_env(*plugins["env"])}
+
+        import marshal
+
+        try:
+            marshal.dumps(plugins)
+        except ValueError:
+            # Only plugins made of builtin types can be sent as they are.
+            # Importing pickle is slow, so we only do it when we have to.
+            from pickle import dumps
+
+            plugins = dumps(plugins)
+
+        try:
+            super().start(plugins, fds=fds)
+        finally:
+            if self._pty is not None:
+                import os
+
+                os.close(self._pty)
+                self._close_terminal()
+
+            if self._signals is not None:
+                import os
+
+                for fd in self._signals:
+                    os.close(fd)
+
+    def signal(self, signal):
+        if self._signals is None:
+            return super().signal(signal)
+
+        # The forked process might run on another machine. The relay sends
+        # the signal to the server once it is not in the middle of a frame.
+        import os
+
+        os.write(self._signals[1], bytes([signal]))
+
+    def _request_fork(self, connection, args, fds=()):
+        if self._signals is not None:
+            self.pid = connection.call("spawn_stream", self._image, args, fds=fds)
+
+            from sys import stderr
+
+            print(f"Attached to process with PID {self.pid}", file=stderr, flush=True)
+            return
+
+        try:
+            super()._request_fork(connection, args, fds)
+        finally:
+            # Only the forked process should hold on to its terminal so that
+            # we notice when it is gone.
+            self._close_terminal()
+
+    def _close_terminal(self):
+        if self._terminal is not None:
+            import os
+
+            os.close(self._terminal)
+            self._terminal = None
 
     def _handle_signals(self):
-        import signal
+        super()._handle_signals()
+
+        if self._pty is not None or self._signals is not None:
+            import _signal
 
-        signal.signal(signal.SIGINT, lambda *args: self.interrupt())
+            _signal.signal(_signal.SIGWINCH, lambda *args: self._resize())
+            for signal in (_signal.SIGTERM, _signal.SIGHUP):
+                _signal.signal(signal, lambda signal, frame: self.signal(signal))
 
     def _join(self):
-        self._server.serve_forever()
+        if self._signals is not None:
+            return self._stream()
 
+        if self._pty is None:
+            return super()._join()
 
-class PluginClient(Client):
-    def start(self, plugins=None):
-        from pickle import dumps
+        import os
+
+        # Keystrokes go to the terminal of the forked process unaltered. It
+        # decides how to echo them and which signals they produce.
+        restore = None
+        if os.isatty(0):
+            import termios
+            import tty
+
+            restore = termios.tcgetattr(0)
+            tty.setraw(0)
+
+        try:
+            self._relay()
+        finally:
+            if restore is not None:
+                termios.tcsetattr(0, termios.TCSAFLUSH, restore)
 
-        super().start(dumps(plugins))
+        super()._join()
+
+    def _relay(self):
+        r"""
+        Copy our stdin to the terminal of the forked process and its output
+        to our stdout until the forked process has terminated.
+        """
+        import os
+        import select
+
+        connection = self._connection.fileno()
+
+        poll = select.poll()
+        poll.register(self._pty, select.POLLIN)
+        poll.register(0, select.POLLIN)
+        poll.register(connection, select.POLLIN)
+
+        while True:
+            for fd, _ in poll.poll():
+                if fd == connection:
+                    # The forked process terminated. Print what is left.
+                    os.set_blocking(self._pty, False)
+                    while self._copy(self._pty, 1):
+                        pass
+                    return
+
+                if not self._copy(fd, self._pty if fd == 0 else 1):
+                    poll.unregister(fd)
+                    if fd == 0 and not os.isatty(0):
+                        # Signal the end of our input like a keyboard would.
+                        os.write(self._pty, b"\x04")
+
+    def _stream(self):
+        r"""
+        Send our stdin and signals to the server and write the output of the
+        forked process that the server sends to our stdout and stderr until
+        the forked process has terminated.
+        """
+        import os
+        import select
+
+        connection = self._connection.fileno()
+
+        poll = select.poll()
+        poll.register(0, select.POLLIN)
+        poll.register(connection, select.POLLIN)
+        poll.register(self._signals[0], select.POLLIN)
+
+        while True:
+            for fd, _ in poll.poll():
+                if fd == connection:
+                    kind, value = self._connection.receive()
+                    if kind == "stdout":
+                        self._write(1, value)
+                    elif kind == "stderr":
+                        self._write(2, value)
+                    elif kind == "timeout":
+                        return self.on_timeout(value)
+                    else:
+                        return self.on_exit(value)
+                elif fd == 0:
+                    try:
+                        data = os.read(0, 1 << 16)
+                    except OSError:
+                        data = b""
+                    self._connection.send(("stdin", data))
+                    if not data:
+                        poll.unregister(0)
+                else:
+                    for signal in os.read(fd, 64):
+                        self._connection.send(("signal", signal))
+
+    @staticmethod
+    def _write(fd, data):
+        import os
+
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+
+    @staticmethod
+    def _copy(source, target):
+        r"""
+        Copy what is available from ``source`` to ``target`` and return
+        whether there was anything to copy.
+        """
+        import os
+
+        try:
+            data = os.read(source, 1 << 16)
+        except (BlockingIOError, OSError):
+            # Reading from a terminal without processes attached fails.
+            return False
+
+        PluginClient._write(target, data)
+
+        return bool(data)
+
+    def _resize(self):
+        r"""
+        Make the terminal of the forked process as large as ours.
+        """
+        import fcntl
+        import termios
+
+        for fd in (0, 1, 2):
+            try:
+                size = fcntl.ioctl(fd, termios.TIOCGWINSZ, b"\0" * 8)
+            except OSError:
+                continue
+            fcntl.ioctl(self._pty, termios.TIOCSWINSZ, size)
+            return
+
+    @classmethod
+    def collect_fds(cls, plugins):
+        r"""
+        Return the file descriptors that need to be sent along with the
+        ``plugins``.
+        """
+        if plugins and "stdio" in plugins:
+            import sys
+
+            return (sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno())
+
+        return ()
 
     @classmethod
     def collect_stdio(cls):
-        import sys
-        import os
+        # The streams are not sent as part of the plugin but as file
+        # descriptors, see collect_fds().
+        return {"stdio": ()}
 
-        stdin = f"/proc/{os.getpid()}/fd/{sys.stdin.fileno()}"
-        stdout = f"/proc/{os.getpid()}/fd/{sys.stdout.fileno()}"
-        stderr = f"/proc/{os.getpid()}/fd/{sys.stderr.fileno()}"
+    @classmethod
+    def collect_pty(cls):
+        r"""
+        Return the plugin that runs the forked process in a fresh
+        pseudo-terminal which we relay to our stdin and stdout.
 
-        return {"stdio": (stdin, stdout, stderr)}
+        Unlike :meth:`collect_stdio`, the forked process then has a
+        controlling terminal. So job control works and it is notified when
+        our terminal is resized.
+        """
+        # The terminal is not part of the plugin but sent as a file
+        # descriptor when the client starts.
+        return {"pty": ()}
+
+    @classmethod
+    def collect_stream(cls):
+        r"""
+        Return the plugin that makes the server relay stdin, stdout and
+        stderr of the forked process over our connection.
+
+        Unlike :meth:`collect_stdio`, this also works when the server runs on
+        another machine, e.g., when connecting over TCP.
+        """
+        return {"stream": ()}
+
+    @classmethod
+    def collect_deadline(cls, timeout=None, cpu_timeout=None):
+        r"""
+        Return the plugin that makes the server stop the forked process
+        after ``timeout`` seconds or ``cpu_timeout`` seconds of CPU time.
+
+        The server might have shorter deadlines of its own.
+        """
+        return {"deadline": (timeout, cpu_timeout)}
 
     @classmethod
     def collect_cwd(cls):
@@ -127,8 +433,335 @@ class PluginClient(Client):
 
         return {"cwd": (os.getcwd(),)}
 
+    def compress_env(self, env):
+        r"""
+        Return the arguments for the ``env`` plugin of the server that
+        recreate the environment ``env`` in the worker.
+
+        Only the differences to the environment of the server are sent if
+        the server published its environment.
+        """
+        from forsake.environment import delta, published
+
+        server = published(self._socket)
+        if server is None:
+            return (env,)
+
+        fingerprint, base = server
+        return (delta(base, env), fingerprint)
+
     @classmethod
     def collect_env(cls):
         import os
 
         return {"env": (dict(os.environ),)}
+
+
+class Executor:
+    r"""
+    Runs functions in processes forked from the server listening on
+    ``socket`` (or from its ``image``) and returns their results as futures.
+
+    This works like :class:`concurrent.futures.ProcessPoolExecutor` but the
+    processes have already done the warmup of the server. Functions, their
+    arguments and their results are sent with :mod:`pickle`. To run a
+    snippet of code, submit :func:`exec`.
+
+    The server must be a :class:`forsake.server.PluginServer`. Up to
+    ``max_workers`` processes run at the same time, by default one per CPU.
+    The server should have a ``concurrency`` that allows it to fork them
+    quickly enough.
+
+    Calls that take more than ``timeout`` seconds are stopped by the server
+    and raise a ``TimeoutError``.
+    """
+
+    def __init__(self, socket, image=None, max_workers=None, timeout=None):
+        import os
+        from concurrent.futures import ThreadPoolExecutor
+
+        self._socket = socket
+        self._image = image
+        self._timeout = timeout
+
+        # Each thread waits for one forked process at a time.
+        self._threads = ThreadPoolExecutor(max_workers=max_workers or os.cpu_count())
+
+    def submit(self, fn, /, *args, **kwargs):
+        r"""
+        Run ``fn(*args, **kwargs)`` in a forked process and return a
+        :class:`concurrent.futures.Future` for its result.
+        """
+        from pickle import dumps
+
+        return self._threads.submit(self._call, dumps((fn, args, kwargs)))
+
+    def map(self, fn, *iterables):
+        r"""
+        Return an iterator over ``fn`` applied to the items of the
+        ``iterables``; each call runs in its own forked process.
+        """
+        futures = [self.submit(fn, *args) for args in zip(*iterables)]
+
+        def results():
+            for future in futures:
+                yield future.result()
+
+        return results()
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self._threads.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def _call(self, call):
+        import socket
+
+        from forsake.buffers import loads
+        from forsake.protocol import RemoteError
+
+        ours, theirs = socket.socketpair()
+        result = Connection(ours)
+        try:
+            connection = Connection.connect(self._socket)
+            try:
+                plugins = {"call": (call, 0)}
+                if self._timeout is not None:
+                    plugins["deadline"] = (self._timeout, None)
+                try:
+                    if self._image is None:
+                        connection.call("spawn", plugins, fds=(theirs.fileno(),))
+                    else:
+                        connection.call(
+                            "spawn_image",
+                            self._image,
+                            plugins,
+                            fds=(theirs.fileno(),),
+                        )
+                finally:
+                    # Only the forked process may hold this end so that we
+                    # notice when it terminates without sending a result.
+                    theirs.close()
+
+                try:
+                    data, layout = result.receive()
+                except EOFError:
+                    data = None
+
+                kind, exitcode = connection.receive()
+            finally:
+                connection.close()
+        finally:
+            result.close()
+            theirs.close()
+
+        if kind == "timeout":
+            raise TimeoutError(f"forked process did not finish within {self._timeout}s")
+
+        if data is None:
+            raise RemoteError(
+                f"forked process terminated with exit code {exitcode} without a result"
+            )
+
+        status, value = loads(data, layout, result.fds[0] if result.fds else None)
+        if status == "raise":
+            raise value
+        return value
+
+
+class AsyncClient:
+    r"""
+    Requests processes from the server listening on ``socket`` from an
+    :mod:`asyncio` event loop.
+
+    Unlike :class:`Client`, this does not block, does not install signal
+    handlers and does not exit the interpreter. So a single event loop can
+    drive many processes at the same time. If ``image`` is set, processes
+    are forked from that image of the server.
+
+    The ``socket`` can also be a ``tcp://HOST:PORT`` address. File
+    descriptors cannot be sent to such servers.
+    """
+
+    def __init__(self, socket, image=None):
+        self._socket = socket
+        self._image = image
+
+    async def spawn(self, args=None, fds=()):
+        r"""
+        Fork a process that runs the ``startup`` of the server with ``args``
+        and return it as an :class:`AsyncProcess` once it is running.
+
+        The file descriptors ``fds`` are sent along with the request so that
+        the forked process can use them.
+        """
+        import asyncio
+        import socket
+
+        from forsake.protocol import RemoteError
+
+        from forsake.protocol import tcp
+
+        loop = asyncio.get_running_loop()
+
+        address = tcp(self._socket)
+        if address is not None:
+            family, _, _, _, address = (
+                await loop.getaddrinfo(*address, type=socket.SOCK_STREAM)
+            )[0]
+            connection = socket.socket(family, socket.SOCK_STREAM)
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.setblocking(False)
+        try:
+            if address is not None:
+                await loop.sock_connect(connection, address)
+
+            while address is None:
+                try:
+                    connection.connect(self._socket)
+                    break
+                except BlockingIOError:
+                    # The backlog of the server is full. Unix sockets do not
+                    # tell us when there is room again, so we retry.
+                    await asyncio.sleep(0.001)
+
+            from forsake.protocol import MAGIC
+
+            await loop.sock_sendall(connection, MAGIC)
+
+            if self._image is None:
+                request = ("spawn", (args,))
+            else:
+                request = ("spawn_image", (self._image, args))
+
+            await _send(loop, connection, request, fds)
+
+            kind, value = await _receive(loop, connection)
+            if kind == "raise":
+                raise RemoteError(value)
+        except BaseException:
+            connection.close()
+            raise
+
+        return AsyncProcess(value, loop, connection, remote=address is not None)
+
+
+class AsyncProcess:
+    r"""
+    A process forked by an :class:`AsyncClient`.
+
+    This mimics :class:`asyncio.subprocess.Process`.
+    """
+
+    def __init__(self, pid, loop, connection, remote=False):
+        self.pid = pid
+        self.returncode = None
+        self._remote = remote
+
+        # Whether the server stopped the process because it exceeded its
+        # deadline.
+        self.timed_out = False
+        self._loop = loop
+        self._connection = connection
+
+    async def wait(self):
+        r"""
+        Wait for the process to terminate and return its exit code.
+
+        Like for :attr:`multiprocessing.Process.exitcode`, a process that was
+        terminated by a signal has the negative signal number as its code.
+        """
+        if self.returncode is None:
+            try:
+                kind, self.returncode = await _receive(self._loop, self._connection)
+                self.timed_out = kind == "timeout"
+            finally:
+                self.close()
+
+        return self.returncode
+
+    def send_signal(self, signal):
+        import os
+
+        if self._remote:
+            raise ValueError("cannot signal a process on another machine")
+
+        if self.returncode is None:
+            os.kill(self.pid, signal)
+
+    def terminate(self):
+        from _signal import SIGTERM
+
+        self.send_signal(SIGTERM)
+
+    def kill(self):
+        from _signal import SIGKILL
+
+        self.send_signal(SIGKILL)
+
+    def close(self):
+        r"""
+        Stop listening for the exit code of the process.
+        """
+        self._connection.close()
+
+
+async def _send(loop, connection, message, fds):
+    r"""
+    Send ``message`` and the file descriptors ``fds`` as a frame of the
+    binary protocol on the non-blocking socket ``connection``.
+    """
+    import marshal
+
+    payload = marshal.dumps(message)
+    frame = len(payload).to_bytes(4, "big") + payload
+
+    ancillary = []
+    if fds:
+        from _socket import SCM_RIGHTS, SOL_SOCKET
+        from array import array
+
+        ancillary = [(SOL_SOCKET, SCM_RIGHTS, array("i", fds))]
+
+    # The file descriptors must go out with the first byte. Once that is
+    # sent, the rest can be sent by the event loop.
+    while True:
+        try:
+            sent = connection.sendmsg([frame], ancillary)
+            break
+        except BlockingIOError:
+            writable = loop.create_future()
+            loop.add_writer(connection.fileno(), writable.set_result, None)
+            try:
+                await writable
+            finally:
+                loop.remove_writer(connection.fileno())
+
+    await loop.sock_sendall(connection, frame[sent:])
+
+
+async def _receive(loop, connection):
+    r"""
+    Return the next message of the binary protocol on the non-blocking
+    socket ``connection``.
+    """
+    import marshal
+
+    async def receive(size):
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        while view:
+            received = await loop.sock_recv_into(connection, view)
+            if not received:
+                raise EOFError("connection closed by peer")
+            view = view[received:]
+        return buffer
+
+    length = int.from_bytes(await receive(4), "big")
+    return marshal.loads(await receive(length))
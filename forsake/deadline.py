@@ -0,0 +1,178 @@
+# ********************************************************************
+#  This file is part of forsake
+#
+#        Copyright (C) 2023 Julian Rüth
+#
+#  forsake is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  forsake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with forsake. If not, see <https://www.gnu.org/licenses/>.
+# ********************************************************************
+
+import threading
+import time
+
+# The signals that stop a worker, gentlest first.
+ESCALATION = ("SIGINT", "SIGTERM", "SIGKILL")
+
+
+class Deadlines:
+    r"""
+    Stops workers that exceed their deadlines in a background thread.
+
+    A worker is stopped by sending it SIGINT, then SIGTERM if it is still
+    running ``grace[0]`` seconds later, and finally SIGKILL if it is still
+    running another ``grace[1]`` seconds later.
+
+    CPU time is read from ``/proc`` so CPU deadlines only work on Linux.
+    """
+
+    def __init__(self, grace=(1, 1)):
+        self._grace = tuple(grace)
+        self._condition = threading.Condition()
+
+        # The workers that are being watched by PID.
+        self._workers = {}
+
+    def start(self):
+        r"""
+        Start stopping workers in a background thread.
+        """
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def watch(self, pid, wall=None, cpu=None):
+        r"""
+        Stop the worker ``pid`` once it ran for ``wall`` seconds or used
+        ``cpu`` seconds of CPU time.
+
+        A worker must be watched so that it can be :meth:`cancel`-ed.
+        """
+        with self._condition:
+            self._workers[pid] = _Worker(wall, cpu)
+            self._condition.notify()
+
+    def cancel(self, pid):
+        r"""
+        Stop the worker ``pid`` right away and return whether it is being
+        watched.
+        """
+        with self._condition:
+            worker = self._workers.get(pid)
+            if worker is None:
+                return False
+
+            if not worker.stage:
+                self._escalate(pid, worker, time.monotonic())
+                self._condition.notify()
+
+            return True
+
+    def forget(self, pid):
+        r"""
+        Stop watching the worker ``pid`` once it terminated and return
+        whether it was stopped because it exceeded a deadline.
+        """
+        with self._condition:
+            worker = self._workers.pop(pid, None)
+            return worker is not None and worker.timeout
+
+    def run(self):
+        while True:
+            with self._condition:
+                now = time.monotonic()
+                wakeup = None
+                for pid, worker in self._workers.items():
+                    if worker.check is not None and worker.check <= now:
+                        self._check(pid, worker, now)
+                    if worker.check is not None:
+                        if wakeup is None or worker.check < wakeup:
+                            wakeup = worker.check
+
+                self._condition.wait(None if wakeup is None else wakeup - now)
+
+    def _check(self, pid, worker, now):
+        if worker.stage:
+            self._escalate(pid, worker, now)
+            return
+
+        if worker.wall is not None and now >= worker.wall:
+            worker.timeout = True
+            self._escalate(pid, worker, now)
+            return
+
+        used = cputime(pid)
+        if used is None:
+            # The worker is gone. The reaper will make us forget it.
+            worker.check = None
+            return
+
+        if used >= worker.cpu:
+            worker.timeout = True
+            self._escalate(pid, worker, now)
+            return
+
+        # The worker cannot use more CPU time than wall time on each of our
+        # CPUs, so there is no need to look again before then.
+        import os
+
+        worker.check = now + max((worker.cpu - used) / os.cpu_count(), 0.01)
+        if worker.wall is not None:
+            worker.check = min(worker.check, worker.wall)
+
+    def _escalate(self, pid, worker, now):
+        import os
+        import signal
+
+        try:
+            os.kill(pid, getattr(signal, ESCALATION[worker.stage]))
+        except ProcessLookupError:
+            pass
+
+        worker.stage += 1
+        worker.check = (
+            now + self._grace[worker.stage - 1]
+            if worker.stage < len(ESCALATION)
+            else None
+        )
+
+
+class _Worker:
+    def __init__(self, wall, cpu):
+        self.cpu = cpu
+        self.wall = None if wall is None else time.monotonic() + wall
+
+        # When to look at this worker again or None if never.
+        self.check = self.wall
+        if cpu is not None:
+            self.check = time.monotonic()
+
+        # The number of signals that we sent to stop the worker.
+        self.stage = 0
+
+        # Whether the worker exceeded one of its deadlines.
+        self.timeout = False
+
+
+def cputime(pid):
+    r"""
+    Return the CPU time in seconds that the process ``pid`` used so far or
+    ``None`` if this is not available.
+    """
+    import os
+
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as stat:
+            fields = stat.read().rpartition(b")")[2].split()
+    except OSError:
+        return None
+
+    # The user and system time come 12th and 13th after the name.
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
@@ -0,0 +1,114 @@
+r"""
+Helpers to send only the differences between the environment variables of a
+client and the ones of the server.
+
+The server publishes its environment next to its socket. A client computes
+the :func:`delta` of its environment against it and the worker only applies
+these changes with :func:`apply`.
+"""
+# ********************************************************************
+#  This file is part of forsake
+#
+#        Copyright (C) 2023 Julian Rüth
+#
+#  forsake is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  forsake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with forsake. If not, see <https://www.gnu.org/licenses/>.
+# ********************************************************************
+
+
+def path(socket):
+    r"""
+    Return the path where the server listening on ``socket`` publishes its
+    environment.
+    """
+    return f"{socket}.env"
+
+
+def fingerprint(environment):
+    r"""
+    Return a string that identifies the ``environment``.
+    """
+    import hashlib
+    import marshal
+
+    return hashlib.sha256(marshal.dumps(sorted(environment.items()))).hexdigest()
+
+
+def publish(socket, environment):
+    r"""
+    Publish ``environment`` for clients of the server listening on ``socket``
+    and return its fingerprint.
+    """
+    import marshal
+    import os
+
+    environment = dict(environment)
+    published = fingerprint(environment)
+
+    # Replace the file atomically so clients never read half of it.
+    target = path(socket)
+    with open(f"{target}.tmp", "wb") as file:
+        file.write(marshal.dumps((published, environment)))
+    os.replace(f"{target}.tmp", target)
+
+    return published
+
+
+def unpublish(socket):
+    import os
+
+    try:
+        os.unlink(path(socket))
+    except FileNotFoundError:
+        pass
+
+
+def published(socket):
+    r"""
+    Return the fingerprint and the environment published by the server
+    listening on ``socket`` or ``None`` if it did not publish any.
+    """
+    import marshal
+
+    try:
+        with open(path(socket), "rb") as file:
+            return marshal.loads(file.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def delta(base, environment):
+    r"""
+    Return the changes that turn the environment ``base`` into
+    ``environment``.
+
+    Variables that need to be removed map to ``None``.
+    """
+    changes = {
+        key: value for key, value in environment.items() if base.get(key) != value
+    }
+    changes.update({key: None for key in base if key not in environment})
+    return changes
+
+
+def apply(changes):
+    r"""
+    Apply the ``changes`` computed by :func:`delta` to ``os.environ``.
+    """
+    import os
+
+    for key, value in changes.items():
+        if value is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = value
@@ -0,0 +1,224 @@
+r"""
+The ``forsake-client`` command line interface.
+
+This does the same as :func:`forsake.cli.client` but it does not use click.
+Most of the time a client needs to run is spent importing modules. So this
+module only imports what is needed to send a request to the server.
+"""
+# ********************************************************************
+#  This file is part of forsake
+#
+#        Copyright (C) 2023 Julian Rüth
+#
+#  forsake is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  forsake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with forsake. If not, see <https://www.gnu.org/licenses/>.
+# ********************************************************************
+
+USAGE = "Usage: forsake-client [OPTIONS]"
+
+HELP = f"""{USAGE}
+
+Options:
+  --socket PATH         the socket the server is listening on, tcp://HOST:PORT
+                        for a server on another machine, or a comma-separated
+                        list of these to pick the least loaded  [required]
+  --startup FILE        the Python code to run in the forked process  [required]
+  --image TEXT          the image of the server to fork the process from
+  --send [source|path]  send the code in FILE or only its path so the server
+                        can reuse the compiled code  [default: source]
+  --pty                 run the process in a pseudo-terminal for interactive
+                        sessions
+  --timeout FLOAT       make the server stop the process after this many
+                        seconds
+  --cpu-timeout FLOAT   make the server stop the process after this many
+                        seconds of CPU time
+  --warmup FILE         start a server with this warmup if none is listening
+                        on the socket
+  --idle-timeout FLOAT  make a server started with --warmup exit after being
+                        idle for this many seconds  [default: 300]
+  --help                Show this message and exit.
+"""
+
+OPTIONS = (
+    "--socket",
+    "--startup",
+    "--image",
+    "--send",
+    "--timeout",
+    "--cpu-timeout",
+    "--warmup",
+    "--idle-timeout",
+)
+
+FLAGS = ("--pty",)
+
+REQUIRED = ("--socket", "--startup")
+
+
+def main(argv=None):
+    import sys
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    options = parse(argv)
+
+    import os.path
+
+    sockets = options["--socket"].split(",")
+    remote = [socket.startswith("tcp://") for socket in sockets]
+
+    if "--warmup" in options:
+        if len(sockets) != 1 or any(remote):
+            usage("Option '--warmup' requires a single Unix socket.")
+        if not os.path.isfile(options["--warmup"]):
+            usage(
+                f"Invalid value for '--warmup': '{options['--warmup']}' is not a file."
+            )
+
+        idle_timeout = options.get("--idle-timeout", "300")
+        try:
+            float(idle_timeout)
+        except ValueError:
+            usage(
+                f"Invalid value for '--idle-timeout': '{idle_timeout}' is not a valid float."
+            )
+
+        # Importing this only when needed keeps the client fast when the
+        # server is up already.
+        from forsake.activation import activate, command
+
+        activate(
+            options["--socket"],
+            command(options["--socket"], options["--warmup"], idle_timeout),
+        )
+    else:
+        for socket, tcp in zip(sockets, remote):
+            if not tcp and not os.path.exists(socket):
+                usage(f"Invalid value for '--socket': Path '{socket}' does not exist.")
+
+    if "--pty" in options and any(remote):
+        usage("Option '--pty' cannot be used with a server on another machine.")
+
+    send = options.get("--send", "source")
+    if send not in ("source", "path"):
+        usage(f"Invalid value for '--send': '{send}' is not one of 'source', 'path'.")
+
+    if send == "path":
+        if not os.path.isfile(options["--startup"]):
+            usage(
+                f"Invalid value for '--startup': '{options['--startup']}' is not a file."
+            )
+        startup = {"script": (os.path.abspath(options["--startup"]),)}
+    else:
+        try:
+            if options["--startup"] == "-":
+                source = sys.stdin.read()
+            else:
+                with open(options["--startup"]) as file:
+                    source = file.read()
+        except OSError as e:
+            usage(
+                f"Invalid value for '--startup': '{options['--startup']}': {e.strerror}"
+            )
+        startup = {"exec": (source,)}
+
+    deadline = []
+    for option in ("--timeout", "--cpu-timeout"):
+        value = options.get(option)
+        if value is not None:
+            try:
+                value = float(value)
+            except ValueError:
+                usage(f"Invalid value for '{option}': '{value}' is not a valid float.")
+        deadline.append(value)
+
+    socket = sockets[0]
+    if len(sockets) > 1:
+        from forsake.balancer import Balancer
+
+        socket = Balancer(sockets).choose()
+
+    from forsake.client import PluginClient
+
+    client = PluginClient(socket, image=options.get("--image"))
+
+    if socket.startswith("tcp://"):
+        # The server cannot reach our streams, and our working directory and
+        # environment might not make sense on its machine.
+        plugins = client.collect_stream()
+    else:
+        plugins = {
+            **client.collect_cwd(),
+            **client.collect_env(),
+            **(client.collect_pty() if "--pty" in options else client.collect_stdio()),
+        }
+
+    client.start({**startup, **plugins, **client.collect_deadline(*deadline)})
+
+
+def parse(argv):
+    r"""
+    Return the options in ``argv`` as a dict.
+
+    Options can be given as ``--option value`` or as ``--option=value``.
+    Flags take no value and map to ``True``.
+    """
+    options = {}
+
+    argv = list(argv)
+    while argv:
+        arg = argv.pop(0)
+
+        if arg == "--help":
+            import sys
+
+            sys.stdout.write(HELP)
+            sys.exit(0)
+
+        if arg in FLAGS:
+            options[arg] = True
+            continue
+
+        option, equals, value = arg.partition("=")
+        if option not in OPTIONS:
+            usage(f"No such option: {option}")
+
+        if not equals:
+            if not argv:
+                usage(f"Option '{option}' requires an argument.")
+            value = argv.pop(0)
+
+        options[option] = value
+
+    for option in REQUIRED:
+        if option not in options:
+            usage(f"Missing option '{option}'.")
+
+    return options
+
+
+def usage(error):
+    r"""
+    Exit with ``error`` like click does when it cannot parse the command line.
+    """
+    import sys
+
+    sys.stderr.write(
+        f"{USAGE}\nTry 'forsake-client --help' for help.\n\nError: {error}\n"
+    )
+    sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -18,29 +18,277 @@
 # ********************************************************************
 
 import multiprocessing
+import threading
 
 
+# Used to run helper processes such as servers and clients in tests.
 context = multiprocessing.get_context("fork")
 
+# Serializes forking with other threads. Threads must also hold this lock
+# while they do anything that could leave the forked process in a broken
+# state, such as writing to a stream which holds a lock on its buffer.
+lock = threading.Lock()
+
+# The ends of the connections that resume parked workers or talk to images.
+# Forked processes must close their copies so that parked workers and images
+# notice when the server is gone.
+_private = set()
+
 
 class Forker:
-    def __init__(self, startup, on_exit):
+    r"""
+    Forks a worker process that runs ``startup(*args, fds=fds)``.
+
+    The worker can be forked right away with :meth:`start` or it can be forked
+    early with :meth:`park` and be given its ``args`` later with
+    :meth:`resume`.
+
+    The worker is a child of the calling process which needs to collect its
+    exit code, e.g., with a :class:`Reaper`.
+
+    The file descriptors ``fds`` are made available in the worker. Their
+    numbers in the worker might differ from the ones in the calling process.
+    """
+
+    def __init__(self, startup):
         self._startup = startup
-        self._on_exit = on_exit
+        self._resume = None
+        self.pid = None
+
+    def start(self, *args, fds=()):
+        r"""
+        Fork a worker that runs ``startup(*args, fds=fds)`` and return its PID.
+
+        Returns once the worker is about to run ``startup``. So signals sent
+        to the PID are not lost while the worker is still setting itself up.
+        """
+        import os
+
+        ready, running = os.pipe()
+
+        def started():
+            os.close(ready)
+            os.write(running, b"\0")
+            os.close(running)
+
+        try:
+            self._fork(lambda: self.work(args, fds, started))
+        finally:
+            os.close(running)
+
+        try:
+            os.read(ready, 1)
+        finally:
+            os.close(ready)
+
+        return self.pid
+
+    def park(self):
+        r"""
+        Fork a worker that waits for :meth:`resume` and return its PID.
+        """
+        from forsake.protocol import Connection
+
+        self._resume, jobs = map(Connection, _socketpair())
+        with lock:
+            _private.add(self._resume)
+
+        try:
+            return self._fork(lambda: self.wait(jobs))
+        finally:
+            jobs.close()
+
+    def resume(self, *args, fds=()):
+        r"""
+        Make the parked worker run ``startup(*args, fds=fds)`` and return its
+        PID.
+
+        Returns once the worker is about to run ``startup``. So signals sent
+        to the PID are not received while the worker is still waiting.
+        """
+        with lock:
+            _private.discard(self._resume)
+        self._resume.send(args, fds)
+        self._resume.receive()
+        self._resume.close()
+        return self.pid
+
+    def close(self):
+        r"""
+        Make a parked worker terminate without running ``startup``.
+        """
+        with lock:
+            _private.discard(self._resume)
+        self._resume.close()
+
+    def _fork(self, target):
+        import os
+
+        with lock:
+            pid = os.fork()
+
+        if pid == 0:
+            os._exit(self._run(target))
+
+        self.pid = pid
+        return pid
+
+    def _run(self, target):
+        r"""
+        Run ``target`` in a forked process and return the exit code for it.
+
+        This mimics what :mod:`multiprocessing` does when running a process.
+        """
+        import os
+        import sys
+
+        exitcode = 1
+        try:
+            for connection in _private:
+                connection.close()
+
+            if sys.stdin is not None:
+                try:
+                    sys.stdin.close()
+                    sys.stdin = open(os.devnull)
+                except (OSError, ValueError):
+                    pass
+
+            target()
+            exitcode = 0
+        except SystemExit as e:
+            if e.code is None:
+                exitcode = 0
+            elif isinstance(e.code, int):
+                exitcode = e.code
+            else:
+                sys.stderr.write(str(e.code) + "\n")
+        except BaseException:
+            import traceback
+
+            traceback.print_exc()
+        finally:
+            for stream in (sys.stdout, sys.stderr):
+                try:
+                    stream.flush()
+                except (AttributeError, ValueError, OSError):
+                    pass
+
+        return exitcode
+
+    def wait(self, jobs):
+        try:
+            args = jobs.receive()
+        except EOFError:
+            # The server went away or it does not need this worker anymore.
+            return
+
+        def started():
+            jobs.send(None)
+            jobs.close()
+
+        self.work(args, jobs.fds, started)
+
+    def work(self, args, fds, started):
+        # Python discards signals that arrive before the forked process is
+        # done setting itself up. So we only report the worker as started
+        # right before it runs startup.
+        started()
+        self._startup(*args, fds=fds)
+
+
+class Reaper:
+    r"""
+    Collects the exit codes of all child processes in a background thread.
+
+    Call :meth:`watch` to be notified when a child terminates. Exit codes are
+    reported like :attr:`multiprocessing.Process.exitcode`, i.e., a child
+    that was killed by a signal has the negative signal number as its exit
+    code.
+
+    Since the reaper collects all children of the process, no other thread
+    should be waiting for child processes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+        # The callbacks of children that are still running.
+        self._watched = {}
+
+        # The exit codes of children that terminated before anybody watched
+        # them.
+        self._exited = {}
+
+        self._thread = threading.Thread(target=self.run, daemon=True)
 
     def start(self):
-        # We have to set daemon=False so that the Forker can have the worker as a child process.
-        pid = context.SimpleQueue()
-        watcher = context.Process(target=self.spawn, args=(pid,), daemon=False)
-        watcher.start()
-        return pid.get()
-
-    def spawn(self, pid):
-        worker = context.Process(target=self.work, args=(), daemon=True)
-        worker.start()
-        pid.put(worker.pid)
-        worker.join()
-        self._on_exit(worker)
-
-    def work(self):
-        self._startup()
+        r"""
+        Start collecting exit codes in a background thread.
+        """
+        self._thread.start()
+
+    def watch(self, pid, on_exit):
+        r"""
+        Call ``on_exit(exitcode)`` from the reaper thread once the child
+        ``pid`` terminated.
+
+        If the child already terminated, ``on_exit`` is called right away.
+        """
+        with self._lock:
+            exitcode = self._exited.pop(pid, None)
+            if exitcode is None:
+                self._watched[pid] = on_exit
+                self._wakeup.set()
+                return
+
+        self._dispatch(on_exit, exitcode)
+
+    def watched(self):
+        r"""
+        Return the PIDs of the children that are being watched and that have
+        not terminated yet.
+        """
+        with self._lock:
+            return list(self._watched)
+
+    def run(self):
+        import os
+
+        while True:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except ChildProcessError:
+                # Sleep until a child is watched. Children that are never
+                # watched are collected once another child is watched.
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            exitcode = os.waitstatus_to_exitcode(status)
+
+            with self._lock:
+                on_exit = self._watched.pop(pid, None)
+                if on_exit is None:
+                    self._exited[pid] = exitcode
+                    continue
+
+            self._dispatch(on_exit, exitcode)
+
+    def _dispatch(self, on_exit, exitcode):
+        try:
+            on_exit(exitcode)
+        except Exception:
+            # A failing callback, e.g., because the client went away, must
+            # not stop the reaper.
+            import traceback
+
+            with lock:
+                traceback.print_exc()
+
+
+def _socketpair():
+    import socket
+
+    return socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
@@ -0,0 +1,221 @@
+# ********************************************************************
+#  This file is part of forsake
+#
+#        Copyright (C) 2023 Julian Rüth
+#
+#  forsake is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  forsake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with forsake. If not, see <https://www.gnu.org/licenses/>.
+# ********************************************************************
+
+import threading
+
+
+class Image:
+    r"""
+    A warm image of the server, i.e., a process forked from the server that
+    ran an additional warmup and now forks workers on behalf of the server.
+
+    The server hands each request to the image together with the connection
+    to the client. The image then reports the PID and exit code of the
+    worker to the client directly.
+    """
+
+    def __init__(self, name, pid, connection, files=None):
+        self.name = name
+        self.pid = pid
+        self._connection = connection
+
+        # The source files that the warmup of the image loaded and their
+        # modification times, see sources().
+        self.files = files or {}
+
+        # Requests and their replies must not interleave.
+        self._lock = threading.Lock()
+
+        # Whether the server stopped using this image, see close().
+        self.closed = False
+
+    @classmethod
+    def start(cls, name, fork):
+        r"""
+        Start an image called ``name`` and return it once it is warm.
+
+        The image is forked by ``fork(fds)`` which returns its PID. The forked
+        process receives the ``fds`` and runs the startup of an image with
+        ``name`` and these ``fds``. The first of these is the connection to
+        the server, see :func:`serve`.
+        """
+        from forsake.forker import _private, _socketpair, lock
+        from forsake.protocol import Connection
+
+        server, image = _socketpair()
+        connection = Connection(server)
+        with lock:
+            _private.add(connection)
+
+        try:
+            try:
+                pid = fork((image.fileno(),))
+            finally:
+                image.close()
+
+            files = connection.result()
+        except BaseException:
+            cls._discard(connection)
+            raise
+
+        return cls(name, pid, connection, files)
+
+    def fork(self, name, fds):
+        r"""
+        Make the image fork another image called ``name`` that starts from
+        the warm state of this image and return its PID.
+        """
+        return self._call("image", name, fds=fds)
+
+    def spawn(self, args, requested, client, fds=()):
+        r"""
+        Make the image fork a worker and return its PID.
+
+        If ``client`` is ``None``, the first of the ``fds`` is the connection
+        to the client. Otherwise, it is the path of the socket where the
+        client wants to be notified about the exit code.
+        """
+        return self._call("spawn", args, requested, client, fds=fds)
+
+    def cancel(self, pid):
+        r"""
+        Make the image stop its worker ``pid`` and return whether it has
+        such a worker.
+        """
+        return self._call("cancel", pid, fds=())
+
+    def promote(self, modules):
+        r"""
+        Make the image import ``modules`` so that its workers do not have to
+        import them anymore.
+        """
+        return self._call("promote", modules, fds=())
+
+    def assets(self):
+        r"""
+        Return how much memory the assets registered in the image use, see
+        :meth:`forsake.server.Server.assets`.
+        """
+        return self._call("assets", fds=())
+
+    def _call(self, method, *params, fds):
+        with self._lock:
+            if self.closed:
+                raise EOFError(f"image {self.name} has been closed")
+            return self._connection.call(method, *params, fds=fds)
+
+    def close(self):
+        r"""
+        Make the image terminate once all of its workers have terminated.
+
+        Requests that are being sent to the image complete first.
+        """
+        with self._lock:
+            self.closed = True
+            self._discard(self._connection)
+
+    @staticmethod
+    def _discard(connection):
+        from forsake.forker import _private, lock
+
+        with lock:
+            _private.discard(connection)
+        connection.close()
+
+
+def sources(files):
+    r"""
+    Return a dict mapping each of the ``files`` to its modification time in
+    nanoseconds or ``None`` if it does not exist.
+
+    Entries of ``files`` that are ``None`` are ignored.
+    """
+    import os
+
+    times = {}
+    for file in files:
+        if file is None:
+            continue
+        try:
+            times[file] = os.stat(file).st_mtime_ns
+        except OSError:
+            times[file] = None
+
+    return times
+
+
+def serve(server, connection):
+    r"""
+    Serve spawn requests for ``server`` that come in on ``connection``.
+
+    This runs in the image once its warmup completed. Returns when the
+    connection is closed and all workers and images that were forked from
+    this image have terminated.
+    """
+    import os
+    import socket
+    import time
+
+    from forsake.protocol import Connection
+
+    from forsake.forker import Forker
+
+    while True:
+        try:
+            method, params = connection.receive()
+        except (EOFError, ConnectionResetError):
+            break
+
+        fds = connection.fds
+        try:
+            if method == "image":
+                # The image is a child of this image so we must reap it. Its
+                # exit code is of no interest.
+                (name,) = params
+                result = Forker(startup=server._image_startup).start(name, fds=fds)
+                server._reaper.watch(result, lambda exitcode: None)
+            elif method == "cancel":
+                (pid,) = params
+                result = server._deadlines.cancel(pid)
+            elif method == "assets":
+                result = server._assets()
+            elif method == "promote":
+                (modules,) = params
+                result = server._promote(modules)
+            else:
+                args, requested, client = params
+
+                server._prepare(args)
+
+                if client is None:
+                    client = Connection(socket.socket(fileno=fds[0]))
+                    fds = fds[1:]
+
+                result = server._forker().start(args, requested, fds=fds)
+                server._watch(client, result, server.deadline(args))
+        except Exception as e:
+            connection.send(("raise", f"{type(e).__name__}: {e}"))
+        else:
+            connection.send(("return", result))
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    while server._reaper.watched():
+        time.sleep(0.01)
@@ -0,0 +1,190 @@
+r"""
+Records which modules workers import after they have been forked.
+
+Every module that a worker imports itself costs the full import time on every
+spawn. The server can record these imports (see the ``imports`` parameter of
+:class:`forsake.server.Server`) and report how often and for how long each
+module was imported (see :meth:`forsake.server.Server.imports`). With
+``promote_imports``, the server imports modules that many workers had to
+import into its warm state so that later workers start with them loaded.
+"""
+# ********************************************************************
+#  This file is part of forsake
+#
+#        Copyright (C) 2023 Julian Rüth
+#
+#  forsake is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  forsake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with forsake. If not, see <https://www.gnu.org/licenses/>.
+# ********************************************************************
+
+import threading
+
+
+class Imports:
+    r"""
+    Collects the modules that workers imported after they were forked.
+
+    Like :class:`forsake.stats.Stats`, this lives in the server and workers
+    send what they recorded with a :class:`Recorder`. Imports are tracked
+    separately for each image the workers were forked from, where ``None``
+    is the warmup of the server itself.
+    """
+
+    def __init__(self):
+        import socket
+
+        self._lock = threading.Lock()
+
+        # The number of workers that reported for each image.
+        self._spawns = {}
+
+        # The number of workers that imported each module and the total
+        # seconds that took by image and module.
+        self._modules = {}
+
+        self._reports, self._sender = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_DGRAM
+        )
+
+    def recorder(self, image=None):
+        r"""
+        Return a :class:`Recorder` for processes forked from ``image``.
+        """
+        return Recorder(self._sender, image)
+
+    def start(self):
+        r"""
+        Start collecting the imports sent by workers in a background thread.
+        """
+        threading.Thread(target=self.receive, daemon=True).start()
+
+    def receive(self):
+        import marshal
+
+        while True:
+            image, modules = marshal.loads(self._reports.recv(65536))
+            self.record(image, modules)
+
+    def record(self, image, modules):
+        r"""
+        Record that a worker forked from ``image`` imported the ``modules``,
+        a list of pairs of module names and seconds that the import took.
+        """
+        with self._lock:
+            self._spawns[image] = self._spawns.get(image, 0) + 1
+            imported = self._modules.setdefault(image, {})
+            for module, seconds in modules:
+                count, total = imported.get(module, (0, 0.0))
+                imported[module] = (count + 1, total + seconds)
+
+    def summary(self):
+        r"""
+        Return a dict mapping each image to the number of ``spawns`` that
+        reported and a dict mapping each imported module to the ``count`` of
+        workers that imported it and the ``sum`` of seconds this took.
+        """
+        with self._lock:
+            return {
+                image: {
+                    "spawns": spawns,
+                    "modules": {
+                        module: {"count": count, "sum": total}
+                        for module, (count, total) in self._modules[image].items()
+                    },
+                }
+                for image, spawns in self._spawns.items()
+            }
+
+    def frequent(self, count):
+        r"""
+        Return a dict mapping images to the modules that at least ``count``
+        of their workers imported.
+        """
+        with self._lock:
+            frequent = {}
+            for image, modules in self._modules.items():
+                names = [name for name, (n, _) in modules.items() if n >= count]
+                if names:
+                    frequent[image] = names
+            return frequent
+
+
+class Recorder:
+    r"""
+    Records the modules that this process imports once :meth:`start`-ed
+    until they are sent to the :class:`Imports` of the server with
+    :meth:`send`.
+
+    Only imports that go through :func:`__import__`, i.e., ``import``
+    statements, are recorded. A module that imports other modules is
+    recorded with the time it took to import all of them.
+    """
+
+    def __init__(self, sender, image):
+        self._sender = sender
+        self._image = image
+        self._imported = []
+
+        # How many recorded imports are in progress. Nested imports are
+        # part of the outermost one.
+        self._depth = 0
+
+    def recorder(self):
+        r"""
+        Return a :class:`Recorder` for a process forked from this one.
+        """
+        return Recorder(self._sender, self._image)
+
+    def start(self):
+        r"""
+        Start recording the imports of this process.
+        """
+        import builtins
+        import sys
+        import time
+
+        original = builtins.__import__
+        modules = sys.modules
+
+        def record(name, globals=None, locals=None, fromlist=(), level=0):
+            # Most imports find their module loaded already so they need to
+            # be fast. Relative imports only happen in packages that are
+            # already being imported.
+            if level or self._depth or name in modules:
+                return original(name, globals, locals, fromlist, level)
+
+            self._depth += 1
+            start = time.monotonic()
+            try:
+                return original(name, globals, locals, fromlist, level)
+            finally:
+                self._depth -= 1
+                if name in modules:
+                    self._imported.append((name, time.monotonic() - start))
+
+        builtins.__import__ = record
+
+    def send(self):
+        import marshal
+        import socket
+
+        imported, self._imported = self._imported, []
+
+        try:
+            self._sender.send(
+                marshal.dumps((self._image, imported)), socket.MSG_DONTWAIT
+            )
+        except OSError:
+            # The server is not keeping up or it is gone. Like statistics,
+            # this is not worth waiting for.
+            pass
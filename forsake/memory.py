@@ -0,0 +1,65 @@
+# ********************************************************************
+#  This file is part of forsake
+#
+#        Copyright (C) 2023 Julian Rüth
+#
+#  forsake is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  forsake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with forsake. If not, see <https://www.gnu.org/licenses/>.
+# ********************************************************************
+
+
+def freeze():
+    r"""
+    Prepare the memory of this process so that forked processes share as
+    much of it with this process as possible.
+
+    Pages are only copied when a forked process writes to them. The cyclic
+    garbage collector writes to every object it visits. So we move all
+    objects that exist now into a permanent generation that the garbage
+    collector ignores, see :func:`gc.freeze`.
+    """
+    import gc
+
+    # Collect garbage first so that it is not kept alive forever.
+    gc.collect()
+    gc.freeze()
+
+
+def usage(pid):
+    r"""
+    Return the memory usage of the process ``pid`` in bytes.
+
+    Returns a dict with the resident set size ``rss``, the proportional set
+    size ``pss`` and the amount of memory that is ``shared`` with other
+    processes or ``private`` to this process.
+
+    Returns ``None`` when this information is not available, e.g., because
+    the process is gone or because this is not Linux.
+    """
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as smaps:
+            for line in smaps:
+                key, _, value = line.partition(":")
+                value = value.split()
+                if len(value) == 2 and value[1] == "kB":
+                    fields[key] = int(value[0]) * 1024
+    except OSError:
+        return None
+
+    return {
+        "rss": fields.get("Rss", 0),
+        "pss": fields.get("Pss", 0),
+        "shared": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0),
+        "private": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+    }
@@ -0,0 +1,90 @@
+# ********************************************************************
+#  This file is part of forsake
+#
+#        Copyright (C) 2023 Julian Rüth
+#
+#  forsake is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  forsake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with forsake. If not, see <https://www.gnu.org/licenses/>.
+# ********************************************************************
+
+
+class Pool:
+    r"""
+    A pool of parked :class:`forsake.forker.Forker` instances.
+
+    Whenever no more than ``low`` workers are parked, :meth:`refill` parks more
+    workers until there are ``high`` of them.
+
+    ``create`` is called without arguments to create a new forker.
+    """
+
+    def __init__(self, create, low, high):
+        if not 0 <= low <= high:
+            raise ValueError("watermarks must satisfy 0 <= low <= high")
+
+        self._create = create
+        self._low = low
+        self._high = high
+        self._parked = []
+        self._refilling = True
+
+    def __len__(self):
+        return len(self._parked)
+
+    def take(self):
+        r"""
+        Return a parked forker or ``None`` if no worker is parked.
+
+        This method can be called from several threads at the same time.
+        """
+        try:
+            forker = self._parked.pop(0)
+        except IndexError:
+            forker = None
+
+        if len(self._parked) <= self._low:
+            self._refilling = True
+
+        return forker
+
+    def fill(self):
+        r"""
+        Park workers until there are ``high`` of them.
+        """
+        while self.refill():
+            pass
+
+    def refill(self):
+        r"""
+        Park another worker if the pool needs refilling.
+
+        Returns whether more workers need to be parked.
+        """
+        if len(self._parked) >= self._high:
+            self._refilling = False
+
+        if not self._refilling:
+            return False
+
+        forker = self._create()
+        forker.park()
+        self._parked.append(forker)
+
+        return len(self._parked) < self._high
+
+    def close(self):
+        r"""
+        Terminate all parked workers.
+        """
+        while self._parked:
+            self._parked.pop().close()
@@ -0,0 +1,225 @@
+# ********************************************************************
+#  This file is part of forsake
+#
+#        Copyright (C) 2023 Julian Rüth
+#
+#  forsake is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  forsake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with forsake. If not, see <https://www.gnu.org/licenses/>.
+# ********************************************************************
+
+from time import monotonic
+
+# Every connection in the binary protocol starts with these bytes. This lets
+# the server tell binary clients apart from legacy XML-RPC clients which start
+# with an HTTP request line.
+MAGIC = b"FSK1"
+
+# The maximum number of file descriptors that can be sent with a frame.
+MAXFDS = 16
+
+
+def tcp(address):
+    r"""
+    Return the host and port of an ``address`` of the form
+    ``tcp://HOST:PORT`` or ``None`` if ``address`` is the path of a Unix
+    socket.
+    """
+    if not address.startswith("tcp://"):
+        return None
+
+    host, _, port = address[len("tcp://") :].rpartition(":")
+    return host.strip("[]"), int(port)
+
+
+class RemoteError(Exception):
+    r"""
+    Raised on the client when a remote procedure failed on the server.
+    """
+
+
+class Connection:
+    r"""
+    A connection that exchanges length-prefixed frames over a stream socket.
+
+    Each frame is a four byte big-endian length followed by a payload that is
+    serialized with :mod:`marshal`. So only builtin types such as ``None``,
+    numbers, strings, bytes, tuples, lists and dicts can be sent.
+
+    Over Unix sockets, file descriptors can be sent along with a frame. They
+    are duplicated into the receiving process, see ``SCM_RIGHTS`` in
+    ``unix(7)``. Over TCP, this is not possible.
+    """
+
+    def __init__(self, socket):
+        self._socket = socket
+
+        # The file descriptors that came with the last frame received. The
+        # receiver owns them and is responsible for closing them.
+        self.fds = []
+
+        # Whether the server handed this connection over to somebody else,
+        # see detach().
+        self.detached = False
+
+        # The time.monotonic() when the last frame started to arrive.
+        self.received = None
+
+    @classmethod
+    def connect(cls, path):
+        r"""
+        Return a connection to the server listening on the Unix socket ``path``
+        or on the TCP address ``tcp://HOST:PORT``.
+        """
+        address = tcp(path)
+        if address is not None:
+            import socket
+
+            sock = socket.create_connection(address)
+            # Frames are small and should not wait for more data to come.
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            # Clients should start quickly. Importing socket would also import
+            # selectors and enum which takes several milliseconds.
+            import _socket
+
+            sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+
+        try:
+            if address is None:
+                sock.connect(path)
+            sock.sendall(MAGIC)
+        except BaseException:
+            sock.close()
+            raise
+
+        return cls(sock)
+
+    @classmethod
+    def fromfd(cls, fd):
+        r"""
+        Return a connection on a duplicate of the socket file descriptor ``fd``.
+        """
+        import socket
+
+        return cls(socket.socket(fileno=socket.dup(fd)))
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def detach(self):
+        r"""
+        Take over this connection from the server.
+
+        The server does not send the result of the current call and stops
+        serving this connection. It closes its copy of the connection without
+        shutting it down so that other processes can continue to use it.
+        """
+        self.detached = True
+
+    def close(self):
+        self._socket.close()
+
+    def send(self, message, fds=()):
+        r"""
+        Send ``message`` as a single frame together with the file descriptors
+        ``fds``.
+        """
+        import marshal
+
+        if len(fds) > MAXFDS:
+            raise ValueError(f"cannot send more than {MAXFDS} file descriptors")
+
+        payload = marshal.dumps(message)
+        self._send([len(payload).to_bytes(4, "big"), payload], fds)
+
+    def receive(self):
+        r"""
+        Return the next message from this connection.
+
+        Any file descriptors that came with the message are stored in
+        :attr:`fds`.
+
+        Raises ``EOFError`` when the other side closed the connection.
+        """
+        import marshal
+
+        # File descriptors are attached to the first byte of a frame.
+        header, self.fds = self._receive_fds(4)
+        if not header:
+            raise EOFError("connection closed by peer")
+
+        self.received = monotonic()
+
+        length = int.from_bytes(header + self._receive(4 - len(header)), "big")
+        return marshal.loads(self._receive(length))
+
+    def call(self, method, *params, fds=()):
+        r"""
+        Run ``method`` with ``params`` on the server and return its result.
+
+        The file descriptors ``fds`` are sent along with the request.
+        """
+        self.send((method, params), fds)
+        return self.result()
+
+    def result(self):
+        r"""
+        Return the result of the last call, i.e., the next ``"return"`` or
+        ``"raise"`` message from the server.
+        """
+        kind, value = self.receive()
+        if kind == "raise":
+            raise RemoteError(value)
+        return value
+
+    def _send(self, buffers, fds=()):
+        # sendmsg writes header and payload with a single system call without
+        # concatenating them first. It might not write everything though.
+        if fds:
+            from _socket import SOL_SOCKET, SCM_RIGHTS
+            from array import array
+
+            sent = self._socket.sendmsg(
+                buffers, [(SOL_SOCKET, SCM_RIGHTS, array("i", fds))]
+            )
+        else:
+            sent = self._socket.sendmsg(buffers)
+        for buffer in buffers:
+            if sent < len(buffer):
+                self._socket.sendall(memoryview(buffer)[sent:])
+            sent = max(sent - len(buffer), 0)
+
+    def _receive_fds(self, size):
+        # Like socket.recv_fds() but without importing socket.
+        from _socket import CMSG_LEN, SOL_SOCKET, SCM_RIGHTS
+        from array import array
+
+        fds = array("i")
+        data, ancdata, _, _ = self._socket.recvmsg(
+            size, CMSG_LEN(MAXFDS * fds.itemsize)
+        )
+        for level, kind, payload in ancdata:
+            if level == SOL_SOCKET and kind == SCM_RIGHTS:
+                fds.frombytes(payload[: len(payload) - len(payload) % fds.itemsize])
+
+        return data, list(fds)
+
+    def _receive(self, size):
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        while view:
+            received = self._socket.recv_into(view)
+            if not received:
+                raise EOFError("connection closed by peer")
+            view = view[received:]
+        return buffer
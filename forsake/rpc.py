@@ -22,6 +22,8 @@ import xmlrpc.server
 import xmlrpc.client
 import socketserver
 
+from forsake.protocol import MAGIC, Connection, tcp
+
 
 class UnixStreamHTTPConnection(HTTPConnection):
     def connect(self):
@@ -49,18 +51,212 @@ class UnixStreamXMLRPCRequestHandler(xmlrpc.server.SimpleXMLRPCRequestHandler):
         return "unix-socket"
 
 
+class RequestHandler(socketserver.BaseRequestHandler):
+    r"""
+    Serves the requests of a single client connection.
+
+    Clients speaking the binary protocol of :class:`forsake.protocol.Connection`
+    announce themselves with :data:`forsake.protocol.MAGIC`. Everything else is
+    handed over to the XML-RPC handler.
+    """
+
+    def handle(self):
+        import socket
+
+        magic = self.request.recv(len(MAGIC), socket.MSG_PEEK | socket.MSG_WAITALL)
+
+        if magic != MAGIC:
+            UnixStreamXMLRPCRequestHandler(
+                self.request, self.client_address, self.server
+            )
+            return
+
+        self.request.recv(len(MAGIC))
+
+        if self.request.family != socket.AF_UNIX:
+            # Frames are small and should not wait for more data to come.
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        connection = Connection(self.request)
+        while True:
+            try:
+                method, params = connection.receive()
+            except EOFError:
+                return
+
+            if self.server.stats is not None:
+                import time
+
+                self.server.stats.record(
+                    "decode", time.monotonic() - connection.received
+                )
+
+            # File descriptors that come with a request are passed as an
+            # additional argument. They are only valid during the call.
+            fds = connection.fds
+            if fds:
+                params = (*params, fds)
+
+            if method in self.server._connected:
+                params = (connection, *params)
+
+            try:
+                result = self.server._dispatch(method, params)
+            except Exception as e:
+                connection.send(("raise", f"{type(e).__name__}: {e}"))
+            else:
+                if connection.detached:
+                    self.server._detached.add(self.request)
+                    return
+
+                connection.send(("return", result))
+            finally:
+                import os
+
+                for fd in fds:
+                    os.close(fd)
+
+
 class Server(socketserver.UnixStreamServer, xmlrpc.server.SimpleXMLRPCDispatcher):
+    r"""
+    Serves the functions registered with :meth:`register_function` on the
+    Unix socket ``socket`` or on the TCP address ``tcp://HOST:PORT``.
+    """
+
+    # If set to a forsake.stats.Stats, the time it takes to receive and
+    # decode requests is recorded there.
+    stats = None
+
+    # Let many clients connect at once without having to wait or retry.
+    request_queue_size = 128
+
     def __init__(self, socket):
         self.logRequests = False
         xmlrpc.server.SimpleXMLRPCDispatcher.__init__(
             self, allow_none=True, encoding=None, use_builtin_types=True
         )
+
+        address = tcp(socket)
+        if address is not None:
+            import socket as sockets
+
+            self.address_family = sockets.getaddrinfo(
+                *address, type=sockets.SOCK_STREAM
+            )[0][0]
+            self.allow_reuse_address = True
+            socket = address
+
         socketserver.UnixStreamServer.__init__(
-            self, socket, UnixStreamXMLRPCRequestHandler, bind_and_activate=True
+            self, socket, RequestHandler, bind_and_activate=True
         )
+        self._services = []
+        self._connected = set()
+        self._detached = set()
+
+    def register_function(self, function=None, name=None, connection=False):
+        r"""
+        Register ``function`` so clients can call it as ``name``.
+
+        If ``connection`` is set, clients of the binary protocol pass their
+        :class:`forsake.protocol.Connection` as the first argument.
+        """
+        if function is None:
+            return lambda function: self.register_function(function, name, connection)
+
+        if connection:
+            self._connected.add(name or function.__name__)
+
+        return super().register_function(function, name)
+
+    def shutdown_request(self, request):
+        if request in self._detached:
+            # Shutting down the socket would end the connection for the
+            # processes that took it over.
+            self._detached.remove(request)
+            self.close_request(request)
+        else:
+            super().shutdown_request(request)
+
+    def register_service(self, function):
+        r"""
+        Register ``function`` to be called in between requests.
+
+        The function is called from :meth:`serve_forever` after each request
+        and whenever no request came in for a while.
+        """
+        self._services.append(function)
+
+    def service_actions(self):
+        super().service_actions()
+
+        for function in self._services:
+            function()
+
+    def pending(self):
+        r"""
+        Return whether a client is waiting for its connection to be accepted.
+        """
+        import select
+
+        return bool(select.select([self], [], [], 0)[0])
+
+
+class ThreadingServer(socketserver.ThreadingMixIn, Server):
+    r"""
+    A :class:`Server` that serves each connection in a separate thread.
+    """
+
+    daemon_threads = True
+
+
+class Client:
+    r"""
+    A proxy for the functions registered with a :class:`Server` that talks the
+    binary protocol of :class:`forsake.protocol.Connection`.
+
+    Like ``xmlrpc.client.ServerProxy``, remote functions are called as methods
+    of this object and the connection is only established on the first call.
+    File descriptors can be sent along with a call by passing them as the
+    keyword argument ``fds``.
+    """
+
+    def __init__(self, socket):
+        self._socket = socket
+        self._connection = None
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        return lambda *params, fds=(): self._call(name, params, fds)
+
+    def _call(self, method, params, fds):
+        if self._connection is None:
+            self._connection = Connection.connect(self._socket)
+
+        return self._connection.call(method, *params, fds=fds)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class XMLRPCClient(xmlrpc.client.ServerProxy):
+    r"""
+    A proxy for the functions registered with a :class:`Server` that talks
+    XML-RPC over HTTP.
 
+    This is much slower than :class:`Client` and only kept for compatibility
+    with clients that cannot speak the binary protocol.
+    """
 
-class Client(xmlrpc.client.ServerProxy):
     def __init__(self, socket):
         super().__init__(
             "http://ignored.invalid",
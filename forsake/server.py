@@ -17,48 +17,1190 @@
 #  along with forsake. If not, see <https://www.gnu.org/licenses/>.
 # ********************************************************************
 
+import contextlib
+import time
+
 import forsake.rpc
 
 
 class Server:
-    def __init__(self, socket):
+    r"""
+    A server that forks a copy of itself for each request of a client.
+
+    If a ``pool`` of watermarks ``(low, high)`` is given, the server keeps up
+    to ``high`` workers forked and waiting for requests. Whenever no more than
+    ``low`` of them are left, the server forks more workers in between
+    requests.
+
+    The server handles up to ``concurrency`` requests at the same time. Each
+    connection is then served in a separate thread so that slow clients do
+    not hold up other clients.
+
+    If ``freeze`` is set, the objects created during :meth:`warmup` are
+    excluded from garbage collection so that forked processes keep sharing
+    the memory they live in with the server, see
+    :func:`forsake.memory.freeze`.
+
+    If ``stats`` is set, the server records how long the phases of each spawn
+    take, see :meth:`stats`. With a ``stats_interval``, a summary of these
+    durations is logged every ``stats_interval`` seconds.
+
+    Besides the server itself, clients can request workers from named
+    :meth:`images`. Each image is a process forked from the server that ran
+    an additional warmup, see :meth:`warm`. Images are started when they
+    are first requested. When there are more than ``max_images`` of them or
+    when they use more than ``max_image_memory`` bytes (of proportional set
+    size), the least recently used images are terminated.
+
+    With ``reload``, the server does not run its :meth:`warmup` itself but
+    in an image. Every ``reload_interval`` seconds, the server checks whether
+    the source files of the modules imported by the warmup of an image
+    changed. If so, it starts a new image in the background and only then
+    sends new requests to it. The old image terminates once all the workers
+    forked from it have terminated.
+
+    With ``max_workers``, at most that many workers run at the same time.
+    Further requests wait until a worker terminates. When ``max_queue``
+    requests are waiting already, further requests are rejected. A server
+    with a ``concurrency`` of 1 cannot wait without blocking all other
+    requests, so it rejects further requests right away.
+
+    Workers run with the resource ``limits``, a dict mapping names such as
+    ``"cpu"`` or ``"as"`` to the values for the corresponding ``RLIMIT_``
+    constants of :mod:`resource`. With ``cgroup``, workers move themselves
+    into the cgroup at that path.
+
+    Workers that run for more than ``timeout`` seconds or that use more than
+    ``cpu_timeout`` seconds of CPU time are stopped, see :meth:`deadline`.
+    They are sent SIGINT, then SIGTERM after ``grace[0]`` seconds and SIGKILL
+    after another ``grace[1]`` seconds. The same happens to workers that
+    are :meth:`cancel`-ed.
+
+    With ``idle_timeout``, the server removes its socket and stops once no
+    worker has been running for that many seconds. Clients can then start a
+    new server when they need one, see :func:`forsake.activation.activate`.
+
+    If ``imports`` is set, the server records which modules workers import
+    after they have been forked, see :meth:`imports`. With
+    ``promote_imports``, modules that that many workers of the server or of
+    an image imported are imported into the server or the image so that
+    later workers do not have to import them anymore.
+    """
+
+    def __init__(
+        self,
+        socket,
+        pool=None,
+        concurrency=1,
+        freeze=False,
+        stats=False,
+        stats_interval=None,
+        max_images=None,
+        max_image_memory=None,
+        reload=False,
+        reload_interval=1,
+        max_workers=None,
+        max_queue=None,
+        limits=None,
+        cgroup=None,
+        timeout=None,
+        cpu_timeout=None,
+        grace=(1, 1),
+        idle_timeout=None,
+        imports=False,
+        promote_imports=None,
+    ):
+        if concurrency < 1:
+            raise ValueError("concurrency must be positive")
+        if max_images is not None and max_images < 1:
+            raise ValueError("max_images must be positive")
+        if reload and pool is not None:
+            raise ValueError("a server that reloads cannot have a pool")
+        if max_queue is not None and max_workers is None:
+            raise ValueError("max_queue requires max_workers")
+        if max_queue and concurrency == 1:
+            raise ValueError("max_queue requires a concurrency of more than 1")
+        if limits:
+            import resource
+
+            for limit in limits:
+                if not hasattr(resource, f"RLIMIT_{limit.upper()}"):
+                    raise ValueError(f"unknown resource limit {limit!r}")
+        if len(grace) != 2 or min(grace) < 0:
+            raise ValueError("grace must be two non-negative periods")
+        if promote_imports is not None and promote_imports < 1:
+            raise ValueError("promote_imports must be positive")
+
         self._socket = socket
+        self._pool = pool
+        self._concurrency = concurrency
+        self._freeze = freeze
+        self._collect_stats = stats or stats_interval is not None
+        self._stats_interval = stats_interval
+        self._max_images = max_images
+        self._max_image_memory = max_image_memory
+        self._reload = reload
+        self._reload_interval = reload_interval
+        self._max_workers = max_workers
+        self._max_queue = max_queue
+        self._limits = limits or {}
+        self._cgroup = cgroup
+        self._timeout = timeout
+        self._cpu_timeout = cpu_timeout
+        self._grace = grace
+        self._idle_timeout = idle_timeout
+        self._collect_imports = imports or promote_imports is not None
+        self._promote_imports = promote_imports
 
     def start(self):
         r"""
         Start the server and listen on the connected host and port.
 
-        This method blocks forever to serve requests.
+        This method blocks forever to serve requests. Only with an
+        ``idle_timeout`` it returns once the server has been idle for that
+        long and it has removed its socket.
         """
-        self.warmup()
+        if not self._reload:
+            self.warmup()
+
+            if self._freeze:
+                from forsake.memory import freeze
+
+                freeze()
+
+        if self._collect_stats:
+            from forsake.stats import Stats
+
+            self._stats = Stats()
+            self._stats.start()
+
+        if self._collect_imports:
+            from forsake.imports import Imports
+
+            self._imports = Imports()
+            self._imports.start()
+
+        # The modules that have been promoted into the warm state of the
+        # server or of an image by name of the image.
+        self._promoted = {}
+
+        from forsake.forker import Reaper
+
+        self._reaper = Reaper()
+        self._reaper.start()
+
+        from forsake.deadline import Deadlines
+
+        self._deadlines = Deadlines(self._grace)
+        self._deadlines.start()
+
+        if self._max_workers is not None or self._idle_timeout is not None:
+            from forsake.admission import Admission
+
+            # Requests wait in the thread that serves them. Without threads,
+            # nothing else could be served in the meantime.
+            max_queue = self._max_queue if self._concurrency > 1 else 0
+            self._admission = Admission(self._max_workers, max_queue)
+            self._admission.start()
+
+        import collections
+        import threading
+
+        # The images that are running, least recently used first.
+        self._images = collections.OrderedDict()
+        self._images_lock = threading.Lock()
+
+        # Makes sure that each image is only started once.
+        self._starting = collections.defaultdict(threading.Lock)
+
+        # How often each image has been reloaded.
+        self._generations = {}
+
+        # The images that are currently being reloaded.
+        self._reloading = set()
+
+        if self._pool is not None:
+            from forsake.pool import Pool
+
+            self._pool = Pool(self._forker, *self._pool)
+            self._pool.fill()
+
+        if self._concurrency == 1:
+            factory = forsake.rpc.Server
+        else:
+            import threading
+
+            factory = forsake.rpc.ThreadingServer
+            self._spawning = threading.BoundedSemaphore(self._concurrency)
+
+        import os
+
+        from forsake.environment import publish, unpublish
+        from forsake.protocol import tcp
+
+        # Clients only send how their environment differs from ours. Clients
+        # on other machines cannot read it, so there is nothing to publish.
+        self._local = tcp(self._socket) is None
+        if self._local:
+            self._published = dict(os.environ)
+            self._environment = publish(self._socket, self._published)
+
+        try:
+            with factory(self._socket) as server:
+                self._server = server
+
+                server.stats = self._stats
+                server.register_function(self.spawn, "spawn", connection=True)
+                server.register_function(
+                    self.spawn_image, "spawn_image", connection=True
+                )
+                server.register_function(
+                    self.spawn_stream, "spawn_stream", connection=True
+                )
+                server.register_function(self.memory, "memory")
+                server.register_function(self.assets, "assets")
+                server.register_function(self.stats, "stats")
+                server.register_function(self.imports, "imports")
+                server.register_function(self.load, "load")
+                server.register_function(self.cancel, "cancel")
+
+                if self._pool is not None:
+                    server.register_service(lambda: self._refill(server))
+
+                if self._stats_interval is not None:
+                    self._logged = time.monotonic()
+                    server.register_service(self._log_stats)
+
+                if self._promote_imports is not None:
+                    server.register_service(self._promote_frequent)
+
+                if self._reload:
+                    # Clients should not have to wait for the warmup.
+                    self._image(None)
 
-        with forsake.rpc.Server(self._socket) as server:
-            server.register_function(self.spawn, "spawn")
+                    self._checked = time.monotonic()
+                    server.register_service(self._check_sources)
 
-            server.serve_forever()
+                # Services run at least this often when there are no requests.
+                poll = 0.5
 
-    def spawn(self, client, args):
+                if self._idle_timeout is not None:
+                    server.register_service(lambda: self._check_idle(server))
+                    poll = min(poll, self._idle_timeout / 4)
+
+                server.serve_forever(poll_interval=poll)
+
+            # We only get here once idle. Workers of requests that came in
+            # while we were stopping still need their exit codes reported.
+            while not self._admission.idle():
+                time.sleep(0.01)
+        finally:
+            if self._local and not self._retired:
+                unpublish(self._socket)
+
+            if self._pool is not None:
+                self._pool.close()
+
+            for image in self._images.values():
+                image.close()
+
+    # The file descriptors that the client sent along with its request. This
+    # is only set in the forked process.
+    fds = ()
+
+    # Limits the number of spawns that are in progress at the same time.
+    _spawning = contextlib.nullcontext()
+
+    # Limits (or only counts) the number of workers that run at the same time.
+    _admission = None
+
+    # Whether the server removed its socket because it was idle.
+    _retired = False
+
+    # The fingerprint of the environment that the server published for its
+    # clients, see forsake.environment.
+    _environment = None
+    _published = None
+
+    # The changes that turn the environment of this process back into the
+    # published one after the warmup of an image changed it, see
+    # startup_env().
+    _restore = None
+
+    # Collects the durations of the phases of spawning, see record(). In
+    # forked processes, this is a report that is sent to the server.
+    _stats = None
+
+    # Collects the modules that workers import after they have been forked,
+    # see imports(). In forked processes, this is a recorder that sends them
+    # to the server.
+    _imports = None
+
+    # The name of the image that this process is running, see imports().
+    _image_name = None
+
+    def spawn(self, client, args, fds=()):
         r"""
         Fork a process, run its :meth:`startup` with ``args`` and report the
-        process ID of the forked process to the caller.
+        process ID and later the exit code of the forked process to the
+        ``client``.
+
+        The ``client`` is the :class:`forsake.protocol.Connection` to the
+        caller. (Older clients pass the path of a socket on which they listen
+        for the exit code instead.)
+
+        The file descriptors ``fds`` are available as :attr:`fds` in the
+        forked process.
         """
-        from forsake.forker import Forker
+        return self.spawn_image(client, None, args, fds)
 
-        forker = Forker(
-            startup=lambda: self.startup(args),
-            on_exit=lambda worker: self.exit(client, worker.exitcode),
-        )
-        pid = forker.start()
+    def spawn_image(self, client, image, args, fds=()):
+        r"""
+        Fork a process from the ``image`` and run its :meth:`startup` with
+        ``args``.
+
+        If ``image`` is ``None``, the process is forked from the server
+        itself, see :meth:`spawn`.
+        """
+        if self._admission is not None:
+            self.record("queue", self._admission.acquire())
+
+        try:
+            with self._spawning:
+                start = time.monotonic()
+                try:
+                    if image is None and not self._reload:
+                        pid = self._spawn(client, args, fds)
+                    else:
+                        pid = self._spawn_image(client, image, args, fds)
+                finally:
+                    self.record("spawn", time.monotonic() - start)
+        except BaseException:
+            if self._admission is not None:
+                self._admission.release()
+            raise
 
         from sys import stderr
+        from forsake.forker import lock
+
+        # Other threads must not fork while we hold the lock of stderr.
+        with lock:
+            print(f"Forked worker with PID {pid}", file=stderr, flush=True)
+
+        return pid
+
+    def spawn_stream(self, client, image, args, fds=()):
+        r"""
+        Fork a process from the ``image`` like :meth:`spawn_image` but relay
+        its stdin, stdout and stderr over the connection to the ``client``.
+
+        This is for clients that cannot send their own streams as file
+        descriptors, e.g., because they connect over TCP. The pipes to the
+        streams are the first three :attr:`fds` of the forked process, see
+        :class:`forsake.stream.Stream` for how they are relayed.
+        """
+        from forsake.stream import Stream
+
+        stream = Stream(client)
+        try:
+            pid = self.spawn_image(stream.reporter, image, args, (*stream.fds, *fds))
+        except BaseException:
+            stream.close()
+            raise
+
+        # The stream takes over the connection to report output and the
+        # exit code.
+        client.detach()
+        stream.start(pid)
+
+        return pid
+
+    def _spawn(self, client, args, fds):
+        self._prepare(args)
+
+        forker = self._pool.take() if self._pool is not None else None
+
+        requested = time.monotonic()
+        if forker is None:
+            pid = self._forker().start(args, requested, fds=fds)
+        else:
+            pid = forker.resume(args, requested, fds=fds)
+        self.record("fork", time.monotonic() - requested)
+
+        if not isinstance(client, str):
+            from forsake.protocol import Connection
+
+            # The reaper takes over the connection to report the exit code.
+            client.detach()
+            client = Connection.fromfd(client.fileno())
+
+        self._watch(client, pid, self.deadline(args))
+
+        return pid
+
+    def _spawn_image(self, client, name, args, fds):
+        callback = client
+        if not isinstance(client, str):
+            # The image takes over the connection to the client.
+            callback = None
+            fds = (client.fileno(), *fds)
+
+        while True:
+            image = self._image(name)
+
+            requested = time.monotonic()
+            try:
+                pid = image.spawn(args, requested, callback, fds=fds)
+                break
+            except (EOFError, OSError):
+                self._forget(image)
+
+                # The image has been evicted or reloaded in the meantime.
+                if image.closed:
+                    continue
+
+                # The image is gone. It is restarted on the next request.
+                raise
+        self.record("fork", time.monotonic() - requested)
 
-        print(f"Forked worker with PID {pid}", file=stderr, flush=True)
+        if callback is None:
+            client.detach()
 
         return pid
 
-    def exit(self, socket, exitcode):
-        with forsake.rpc.Client(socket) as proxy:
-            proxy.exit(exitcode)
+    def prepare(self, args):
+        r"""
+        Prepare this process for forking a worker that runs :meth:`startup`
+        with ``args``.
+
+        This runs right before the fork in the server or in the image that
+        forks the worker. So the worker inherits whatever is done here.
+        Raising an exception rejects the request.
+
+        Does nothing by default.
+        """
+
+    def _prepare(self, args):
+        start = time.monotonic()
+        try:
+            self.prepare(args)
+        finally:
+            self.record("prepare", time.monotonic() - start)
+
+    def deadline(self, args):
+        r"""
+        Return the number of seconds and the CPU time in seconds after which
+        the worker that runs :meth:`startup` with ``args`` is stopped.
+
+        Either can be ``None`` for no limit. Returns the ``timeout`` and
+        ``cpu_timeout`` of the server by default.
+        """
+        return self._timeout, self._cpu_timeout
+
+    def cancel(self, pid):
+        r"""
+        Stop the worker ``pid`` like a worker that exceeded its deadline and
+        return whether there is such a worker.
+
+        Unlike signaling the worker directly, this also stops workers that
+        ignore SIGINT and it works for anybody who can talk to the server,
+        e.g., when the client that requested the worker is gone.
+        """
+        if self._deadlines.cancel(pid):
+            return True
+
+        # The worker might have been forked from an image.
+        with self._images_lock:
+            images = list(self._images.values())
+
+        for image in images:
+            try:
+                if image.cancel(pid):
+                    return True
+            except (EOFError, OSError):
+                pass
+
+        return False
+
+    def _watch(self, client, pid, deadline):
+        # We report the PID ourselves so that it is guaranteed to arrive
+        # before the exit code.
+        if not isinstance(client, str):
+            client.send(("return", pid))
+
+        self._deadlines.watch(pid, *deadline)
+        self._reaper.watch(pid, lambda exitcode: self._exited(client, pid, exitcode))
+
+    def images(self):
+        r"""
+        Return the names of the images that clients can request.
+
+        By default, each method ``warmup_{name}`` defines an image ``name``.
+        """
+        return [
+            attr[len("warmup_") :]
+            for attr in dir(type(self))
+            if attr.startswith("warmup_")
+        ]
+
+    def warm(self, image):
+        r"""
+        Prepare this process, a fork of the server or of the :meth:`parent`
+        image, to become the ``image``.
+
+        By default, this runs the method ``warmup_{image}``.
+        """
+        getattr(self, f"warmup_{image}")()
+
+    def parent(self, image):
+        r"""
+        Return the name of the image that ``image`` is forked from or
+        ``None`` if it is forked from the server itself.
+
+        The :meth:`warm` of ``image`` then only needs to do what its parent
+        did not already do.
+        """
+        return None
+
+    def layer(self, image):
+        r"""
+        Return the source code of the warmup of ``image``.
+
+        Images are identified by the source code of their warmup and the
+        warmups of their parents. So two images with the same warmup share a
+        process and an image is started again if its warmup changed.
+        """
+        import inspect
+
+        warmup = getattr(type(self), f"warmup_{image}")
+        try:
+            return inspect.getsource(warmup)
+        except (OSError, TypeError):
+            return warmup.__qualname__
+
+    def _layers(self, name, generations=None):
+        r"""
+        Return the names and keys of the image ``name`` and its parents,
+        starting with the image that is forked from the server itself.
+
+        With ``reload``, the warmup of the server itself is the image
+        ``None`` from which all other images are forked.
+
+        The keys depend on how often each image has been reloaded as given by
+        ``generations``, by default the current generations.
+        """
+        import hashlib
+
+        if generations is None:
+            generations = self._generations
+
+        names = [name]
+        parent = None if name is None else self.parent(name)
+        while parent is not None:
+            if parent in names:
+                raise ValueError(f"image {name!r} is its own parent")
+            names.append(parent)
+            parent = self.parent(parent)
+
+        if self._reload and name is not None:
+            names.append(None)
+
+        layers = []
+        key = ""
+        for name in reversed(names):
+            if name is None:
+                layer = ""
+            elif name in self.images():
+                layer = self.layer(name)
+            else:
+                raise ValueError(f"server has no image {name!r}")
+
+            generation = generations.get(name, 0)
+            key = hashlib.sha256(f"{key}\0{layer}\0{generation}".encode()).hexdigest()
+            layers.append((name, key))
+
+        return layers
+
+    def _image(self, name, generations=None):
+        r"""
+        Return the running image ``name``; start it and its parents if needed.
+        """
+        layers = self._layers(name, generations)
+
+        image = None
+        for name, key in layers:
+            image = self._layer(name, key, image)
+
+        keep = {key for _, key in layers}
+        if self._reload:
+            # The warmup of the server is never evicted.
+            keep.add(self._layers(None)[0][1])
+
+        with self._images_lock:
+            # Parents are evicted only after their children.
+            for _, key in layers:
+                if key in self._images:
+                    self._images.move_to_end(key)
+            evicted = self._evict(keep=keep)
+
+        for stale in evicted:
+            stale.close()
+
+        return image
+
+    def _layer(self, name, key, parent):
+        r"""
+        Return the running image ``name`` identified by ``key``; fork it from
+        the ``parent`` image or from the server if it is not running.
+        """
+        with self._starting[key]:
+            with self._images_lock:
+                image = self._images.get(key)
+                if image is not None:
+                    return image
+
+            from forsake.image import Image
+
+            if parent is None:
+                from forsake.forker import Forker
+
+                forker = Forker(startup=self._image_startup)
+                image = Image.start(name, lambda fds: forker.start(name, fds=fds))
+                self._reaper.watch(image.pid, lambda exitcode: self._forget(image))
+            else:
+                # The image is not our child. We notice that it is gone when
+                # we cannot talk to it anymore.
+                image = Image.start(name, lambda fds: parent.fork(name, fds))
+
+            from sys import stderr
+            from forsake.forker import lock
+
+            with lock:
+                print(
+                    f"Started image {name or 'of the server'} with PID {image.pid}",
+                    file=stderr,
+                    flush=True,
+                )
+
+            promoted = self._promoted.get(name)
+            if promoted:
+                # Modules that workers of earlier images had to import.
+                image.promote(sorted(promoted))
+
+            with self._images_lock:
+                self._images[key] = image
+
+            return image
+
+    def _check_sources(self):
+        now = time.monotonic()
+        if now - self._checked < self._reload_interval:
+            return
+        self._checked = now
+
+        import threading
+
+        from forsake.image import sources
+
+        with self._images_lock:
+            images = list(self._images.items())
+
+        for key, image in images:
+            if image.name in self._reloading:
+                continue
+            if self._layers(image.name)[-1][1] != key:
+                continue
+
+            current = sources(image.files)
+            if current == image.files:
+                continue
+
+            # Only retry when something changes again if the reload fails.
+            image.files = current
+
+            self._reloading.add(image.name)
+            threading.Thread(
+                target=self._reload_image, args=(image.name,), daemon=True
+            ).start()
+
+    def _reload_image(self, name):
+        r"""
+        Start a fresh image ``name`` (and fresh images for the running images
+        forked from it), then make new requests use them and drain the old
+        images.
+        """
+        from sys import stderr
+        from forsake.forker import lock
+
+        try:
+            generations = dict(self._generations)
+            generations[name] = generations.get(name, 0) + 1
+
+            with self._images_lock:
+                running = {image.name for image in self._images.values()}
+
+            for image in running:
+                if name in [layer for layer, _ in self._layers(image)]:
+                    self._image(image, generations)
+
+            self._generations = generations
+
+            with self._images_lock:
+                stale = [
+                    key
+                    for key, image in self._images.items()
+                    if self._layers(image.name)[-1][1] != key
+                ]
+                stale = [self._images.pop(key) for key in stale]
+
+            for image in stale:
+                image.close()
+
+            with lock:
+                print(
+                    f"Reloaded image {name or 'of the server'}", file=stderr, flush=True
+                )
+        except Exception:
+            import traceback
+
+            with lock:
+                traceback.print_exc()
+        finally:
+            self._reloading.discard(name)
+
+    def _evict(self, keep):
+        r"""
+        Remove the least recently used images that are not in ``keep`` until
+        the running images fit into the limits, and return them.
+        """
+        from forsake.memory import usage
+
+        def exceeded():
+            if self._max_images is not None and len(self._images) > self._max_images:
+                return True
+            if self._max_image_memory is not None:
+                used = sum(
+                    (usage(image.pid) or {}).get("pss", 0)
+                    for image in self._images.values()
+                )
+                return used > self._max_image_memory
+            return False
+
+        evicted = []
+        while exceeded():
+            key = next((key for key in self._images if key not in keep), None)
+            if key is None:
+                break
+            evicted.append(self._images.pop(key))
+
+        return evicted
+
+    def _forget(self, image):
+        with self._images_lock:
+            for key, running in list(self._images.items()):
+                if running is image:
+                    del self._images[key]
+
+    def _image_startup(self, name, fds):
+        import socket
+
+        from forsake.forker import Reaper, _private, lock
+        from forsake.image import serve
+        from forsake.protocol import Connection
+
+        connection = Connection(socket.socket(fileno=fds[0]))
+
+        # Processes forked from this image must not hold on to the connection.
+        with lock:
+            _private.add(connection)
+
+        self._image_name = name
+
+        # Only the server accepts connections and manages images and pools.
+        self._server.socket.close()
+        self._pool = None
+        self._images = {}
+
+        import sys
+
+        from forsake.image import sources
+
+        modules = set(sys.modules)
+
+        try:
+            if name is None:
+                self.warmup()
+            else:
+                self.warm(name)
+
+            if self._published is not None:
+                import os
+
+                from forsake.environment import delta
+
+                self._restore = delta(os.environ, self._published)
+
+            if self._freeze:
+                from forsake.memory import freeze
+
+                freeze()
+        except Exception as e:
+            connection.send(("raise", f"{type(e).__name__}: {e}"))
+            raise
+
+        self._reaper = Reaper()
+        self._reaper.start()
+
+        from forsake.deadline import Deadlines
+
+        self._deadlines = Deadlines(self._grace)
+        self._deadlines.start()
+
+        if self._stats is not None:
+            self._stats = self._stats.report()
+
+        # Report the files that the server needs to watch for changes.
+        connection.send(
+            (
+                "return",
+                sources(
+                    getattr(module, "__file__", None)
+                    for name, module in list(sys.modules.items())
+                    if name not in modules
+                ),
+            )
+        )
+
+        serve(self, connection)
+
+    def memory(self):
+        r"""
+        Return the memory usage of the server and of its running workers.
+
+        Returns a dict mapping PIDs to their usage as reported by
+        :func:`forsake.memory.usage`. Memory that a worker shares with the
+        server is reported as ``shared``.
+        """
+        import os
+
+        from forsake.memory import usage
+
+        report = {}
+        for pid in [os.getpid(), *self._reaper.watched()]:
+            pages = usage(pid)
+            if pages is not None:
+                report[pid] = pages
+
+        return report
+
+    def assets(self):
+        r"""
+        Return how much memory the assets registered with
+        :func:`forsake.assets.register` use in the server, its images and
+        their workers.
+
+        Returns a dict mapping the names of the assets to their usage as
+        reported by :func:`forsake.assets.usage`. Assets of images are
+        prefixed with the name of the image and a slash.
+        """
+        report = self._assets()
+
+        with self._images_lock:
+            images = list(self._images.values())
+
+        for image in images:
+            try:
+                usage = image.assets()
+            except (EOFError, OSError):
+                continue
+
+            for name, pages in usage.items():
+                if image.name is not None:
+                    name = f"{image.name}/{name}"
+                if name in report:
+                    # Generations of the same image report the same assets.
+                    for key in ["rss", "pss", "saved"]:
+                        report[name][key] += pages[key]
+                else:
+                    report[name] = pages
+
+        return report
+
+    def _assets(self):
+        r"""
+        Return the usage of the assets that were registered in this process
+        by this process and its workers.
+        """
+        import os
+
+        from forsake.assets import usage
+
+        return usage([os.getpid(), *self._reaper.watched()])
+
+    def stats(self):
+        r"""
+        Return statistics about the durations of the phases of spawning.
+
+        Returns a dict mapping each phase to the count, sum, min, max and
+        percentiles of its durations in seconds, see
+        :meth:`forsake.stats.Histogram.summary`. The phases are
+
+        * ``decode``: reading and decoding a request,
+        * ``spawn``: handling a spawn request in the server,
+        * ``fork``: forking a worker or handing the request to a pooled one,
+        * ``handoff``: from the server handing off a request until the
+          worker runs its :meth:`startup`,
+        * ``exit``: reporting the exit code of a worker to the client.
+
+        Subclasses can record additional phases with :meth:`record`.
+
+        Returns an empty dict if the server does not collect statistics.
+        """
+        if self._stats is None:
+            return {}
+
+        return self._stats.summary()
+
+    def imports(self):
+        r"""
+        Return which modules workers imported after they have been forked.
+
+        Returns a dict mapping each module to the ``count`` of workers that
+        imported it, the ``sum`` of seconds that took, and the number of
+        ``spawns`` that were recorded. Modules imported by workers of images
+        are prefixed with the name of the image and a slash.
+
+        Returns an empty dict if the server does not record imports.
+        """
+        if self._imports is None:
+            return {}
+
+        report = {}
+        for image, imported in self._imports.summary().items():
+            for module, usage in imported["modules"].items():
+                if image is not None:
+                    module = f"{image}/{module}"
+                report[module] = {**usage, "spawns": imported["spawns"]}
+
+        return report
+
+    def _promote_frequent(self):
+        r"""
+        Import the modules that ``promote_imports`` workers of the server or
+        of an image had to import into the server or the image.
+        """
+        for name, modules in self._imports.frequent(self._promote_imports).items():
+            promoted = self._promoted.setdefault(name, set())
+            modules = [module for module in modules if module not in promoted]
+            if not modules:
+                continue
+
+            promoted.update(modules)
+
+            if name is None and not self._reload:
+                self._promote(modules)
+
+            with self._images_lock:
+                images = [
+                    image for image in self._images.values() if image.name == name
+                ]
+
+            for image in images:
+                try:
+                    image.promote(modules)
+                except (EOFError, OSError):
+                    pass
+
+    def _promote(self, modules):
+        r"""
+        Import ``modules`` into this process so that workers forked from it
+        do not have to import them anymore.
+        """
+        import importlib
+        from sys import stderr
+
+        from forsake.forker import lock
+
+        # Nothing must be forked while the import holds locks.
+        with lock:
+            for module in modules:
+                try:
+                    importlib.import_module(module)
+                except Exception as e:
+                    print(
+                        f"Could not promote {module} into the warmup: {type(e).__name__}: {e}",
+                        file=stderr,
+                        flush=True,
+                    )
+                else:
+                    print(f"Promoted {module} into the warmup", file=stderr, flush=True)
+
+            if self._freeze:
+                from forsake.memory import freeze
+
+                freeze()
+
+    def load(self):
+        r"""
+        Return how many workers are running and how many requests are
+        waiting for a worker, together with their limits.
+
+        Returns ``None`` if the server does not keep track of its workers,
+        i.e., when it has neither ``max_workers`` nor an ``idle_timeout``.
+        """
+        if self._admission is None:
+            return None
+
+        return self._admission.load()
+
+    def record(self, phase, seconds):
+        r"""
+        Record that ``phase`` took ``seconds``.
+
+        Does nothing if the server does not collect statistics. In forked
+        processes, durations are kept until they are sent to the server with
+        :meth:`send_stats`.
+        """
+        if self._stats is not None:
+            self._stats.record(phase, seconds)
+
+    def send_stats(self):
+        r"""
+        Send the durations recorded in this forked process to the server.
+
+        Does nothing in the server itself.
+        """
+        if self._stats is not None:
+            self._stats.send()
+
+    def _log_stats(self):
+        now = time.monotonic()
+        if now - self._logged < self._stats_interval:
+            return
+        self._logged = now
+
+        from sys import stderr
+        from forsake.forker import lock
+
+        line = self._stats.line()
+        if not line:
+            return
+
+        with lock:
+            print(f"Spawn statistics: {line}", file=stderr, flush=True)
+
+    def _forker(self):
+        from forsake.forker import Forker
+
+        return Forker(startup=self._startup)
+
+    def _startup(self, args, requested, fds):
+        if self._stats is not None:
+            self._stats = self._stats.report()
+            self.record("handoff", time.monotonic() - requested)
+
+        self._limit()
+
+        if self._imports is not None:
+            self._imports = self._imports.recorder(self._image_name)
+            self._imports.start()
+
+        self.fds = fds
+        try:
+            self.startup(args)
+        finally:
+            if self._imports is not None:
+                self._imports.send()
+        self.send_stats()
+
+    def _limit(self):
+        r"""
+        Apply the resource limits and the cgroup to this worker.
+        """
+        if self._cgroup is not None:
+            import os
+
+            with open(os.path.join(self._cgroup, "cgroup.procs"), "w") as procs:
+                procs.write(str(os.getpid()))
+
+        if self._limits:
+            import resource
+
+            for limit, value in self._limits.items():
+                resource.setrlimit(
+                    getattr(resource, f"RLIMIT_{limit.upper()}"), (value, value)
+                )
+
+    def _exited(self, client, pid, exitcode):
+        # The worker is gone, so another one may run before we tell anyone.
+        if self._admission is not None:
+            self._admission.release()
+
+        timeout = self._deadlines.forget(pid)
+
+        start = time.monotonic()
+        try:
+            self.exit(client, exitcode, timeout)
+        finally:
+            if not isinstance(client, str):
+                client.close()
+            self.record("exit", time.monotonic() - start)
+            self.send_stats()
+
+    def _check_idle(self, server):
+        r"""
+        Stop serving if no worker has been running for ``idle_timeout``
+        seconds.
+        """
+        if self._retired or self._admission.idle() < self._idle_timeout:
+            return
+
+        import os
+        import threading
+
+        from forsake.environment import unpublish
+
+        # Clients that come after us should start a new server instead of
+        # connecting to one that is going away.
+        self._retired = True
+        if self._local:
+            os.unlink(self._socket)
+            unpublish(self._socket)
+
+        from sys import stderr
+        from forsake.forker import lock
+
+        with lock:
+            print(
+                f"Stopping after being idle for {self._idle_timeout}s",
+                file=stderr,
+                flush=True,
+            )
+
+        # Requests that are still pending are served until serve_forever()
+        # notices, which happens in another thread since shutdown() waits
+        # for it.
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    def _refill(self, server):
+        # Park workers until the pool is full or a client is waiting so that
+        # a client never has to wait for more than a single worker to park.
+        while self._pool.refill() and not server.pending():
+            pass
+
+    def exit(self, client, exitcode, timeout=False):
+        r"""
+        Report the ``exitcode`` of a forked process to the ``client``.
+
+        If the process was stopped because it exceeded its deadline, this is
+        reported as a ``"timeout"`` instead of an ``"exit"``. (Older clients
+        that pass a path only learn about the exit code.)
+        """
+        if isinstance(client, str):
+            with forsake.rpc.XMLRPCClient(client) as proxy:
+                proxy.exit(exitcode)
+        else:
+            client.send(("timeout" if timeout else "exit", exitcode))
 
     def warmup(self):
         r"""
@@ -77,16 +1219,95 @@ class Server:
 
 
 class PluginServer(Server):
+    def prepare(self, plugins):
+        r"""
+        Run ``prepare_{section}(*args)`` for each ``section`` and ``args`` in
+        ``plugins`` if there is such a method.
+
+        Plugins that clients sent pickled are not prepared.
+        """
+        if isinstance(plugins, dict):
+            for section, args in plugins.items():
+                prepare = getattr(self, f"prepare_{section}", None)
+                if prepare is not None:
+                    prepare(*args)
+
+    def deadline(self, plugins):
+        r"""
+        Return the deadlines of the server, shortened by the ``deadline``
+        plugin if the client sent one, see
+        :meth:`forsake.client.PluginClient.collect_deadline`.
+
+        Clients cannot extend the deadlines of the server. Plugins that
+        clients sent pickled are ignored.
+        """
+        deadline = super().deadline(plugins)
+
+        if isinstance(plugins, dict) and "deadline" in plugins:
+            deadline = tuple(
+                (
+                    ours
+                    if theirs is None
+                    else theirs if ours is None else min(ours, theirs)
+                )
+                for ours, theirs in zip(deadline, plugins["deadline"])
+            )
+
+        return deadline
+
     def startup(self, plugins):
-        if plugins is not None:
+        r"""
+        Run ``startup_{section}(*args)`` for each ``section`` and ``args`` in
+        ``plugins``.
+
+        Clients send ``plugins`` as a dict or as a pickled dict when it
+        cannot be sent as it is.
+        """
+        if isinstance(plugins, bytes):
             from pickle import loads
 
+            start = time.monotonic()
             plugins = loads(plugins)
+            self.record("loads", time.monotonic() - start)
+
+        if plugins is not None:
             for section, args in plugins.items():
+                start = time.monotonic()
                 getattr(self, f"startup_{section}")(*args)
+                self.record(f"startup_{section}", time.monotonic() - start)
+
+        # Subclasses might never return from startup so we report now.
+        self.send_stats()
+
+    def startup_stdio(self, *paths):
+        r"""
+        Connect stdin, stdout, stderr of this process to the ones of the
+        client.
 
-    def startup_stdio(self, stdin, stdout, stderr):
+        The client sends its stdin, stdout, stderr as the first three
+        :attr:`fds`. (Older clients send the ``paths`` of these streams
+        instead which only works when we can open them on this machine.)
+        """
         import sys
+        import os
+
+        if not paths:
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+            for target, fd in enumerate(self.fds[:3]):
+                os.dup2(fd, target)
+                os.close(fd)
+
+            # The old stdin might have buffered data from our own stdin.
+            sys.stdin = open(0, "r", closefd=False)
+
+            # Use the buffering that Python would use for the client's stdout.
+            sys.stdout.reconfigure(line_buffering=os.isatty(1))
+
+            return
+
+        stdin, stdout, stderr = paths
 
         sys.stdin.close()
         sys.stdin = open(stdin, "r")
@@ -97,15 +1318,115 @@ class PluginServer(Server):
         sys.stderr.close()
         sys.stderr = open(stderr, "w")
 
+    def startup_stream(self):
+        r"""
+        Connect stdin, stdout, stderr of this process to the pipes that the
+        server relays to the client, see :meth:`spawn_stream`.
+        """
+        self.startup_stdio()
+
+    def startup_pty(self):
+        r"""
+        Make the pseudo-terminal that the client sends as the first of the
+        :attr:`fds` the controlling terminal of this process and connect
+        stdin, stdout, stderr to it.
+
+        The client relays the terminal to its own stdin and stdout, see
+        :meth:`forsake.client.PluginClient.collect_pty`.
+        """
+        import fcntl
+        import os
+        import sys
+        import termios
+
+        terminal = self.fds[0]
+
+        # Only the leader of a session without a terminal can acquire one.
+        os.setsid()
+        fcntl.ioctl(terminal, termios.TIOCSCTTY, 0)
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        for target in range(3):
+            os.dup2(terminal, target)
+        os.close(terminal)
+
+        # The old stdin might have buffered data from our own stdin.
+        sys.stdin = open(0, "r", closefd=False)
+
+        sys.stdout.reconfigure(line_buffering=True)
+
+    def startup_deadline(self, timeout, cpu_timeout):
+        r"""
+        Do nothing; the server that forked this process enforces the
+        deadlines, see :meth:`deadline`.
+        """
+
+    def startup_call(self, call, fd):
+        r"""
+        Run a function sent by a :class:`forsake.client.Executor` and send
+        the pickled result to the client through the socket ``fds[fd]``.
+
+        Large buffers in the result, such as the data of numpy arrays, are
+        sent through shared memory, see :mod:`forsake.buffers`.
+        """
+        import os
+        import pickle
+        import socket
+
+        from forsake.buffers import dumps
+        from forsake.protocol import Connection, RemoteError
+
+        fn, args, kwargs = pickle.loads(call)
+        try:
+            result = ("return", fn(*args, **kwargs))
+        except Exception as e:
+            result = ("raise", e)
+
+        try:
+            data, layout, memory = dumps(result)
+        except Exception as e:
+            data, layout, memory = dumps(
+                ("raise", RemoteError(f"cannot send result: {type(e).__name__}: {e}"))
+            )
+
+        client = Connection(socket.socket(fileno=self.fds[fd]))
+        try:
+            client.send((data, layout), fds=() if memory is None else (memory,))
+        finally:
+            client.close()
+            if memory is not None:
+                os.close(memory)
+
     def startup_cwd(self, cwd):
         import os
 
         os.chdir(cwd)
 
-    def startup_env(self, env):
+    def startup_env(self, env, base=None):
+        r"""
+        Set the environment variables of this process to the ones of the
+        client.
+
+        The client sends the changes that turn the environment with the
+        fingerprint ``base``, as published by the server, into its
+        environment, see :func:`forsake.environment.delta`. (Older clients
+        send their full environment ``env`` instead.)
+        """
         import os
 
-        for key in os.environ:
-            del os.environ[key]
-        for key, value in env.items():
-            os.environ[key] = value
+        from forsake.environment import apply, delta
+
+        if base is None:
+            env = delta(os.environ, env)
+        elif base != self._environment:
+            raise ValueError(
+                "client sent its environment relative to an environment that is not the one of this server"
+            )
+        elif self._restore:
+            # The changes of the client are relative to the environment that
+            # the server published, not to the one our image warmed up with.
+            apply(self._restore)
+
+        apply(env)
@@ -0,0 +1,195 @@
+# ********************************************************************
+#  This file is part of forsake
+#
+#        Copyright (C) 2023 Julian Rüth
+#
+#  forsake is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  forsake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with forsake. If not, see <https://www.gnu.org/licenses/>.
+# ********************************************************************
+
+import threading
+
+
+class Histogram:
+    r"""
+    A histogram of durations with logarithmic buckets.
+
+    Each power of two is split into ``RESOLUTION`` buckets so percentiles
+    are accurate to about 20%.
+    """
+
+    RESOLUTION = 4
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self._buckets = {}
+
+    def add(self, seconds):
+        from math import frexp
+
+        self.count += 1
+        self.sum += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+        mantissa, exponent = frexp(seconds)
+        bucket = exponent * self.RESOLUTION + int((2 * mantissa - 1) * self.RESOLUTION)
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+
+    def percentile(self, percent):
+        r"""
+        Return an upper bound for the ``percent`` percentile of the durations.
+        """
+        from math import ceil, ldexp
+
+        if not self.count:
+            return None
+
+        rank = ceil(self.count * percent / 100)
+        seen = 0
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                exponent, step = divmod(bucket, self.RESOLUTION)
+                upper = ldexp(0.5 + (step + 1) / (2 * self.RESOLUTION), exponent)
+                return min(upper, self.max)
+
+    def summary(self):
+        r"""
+        Return the statistics of this histogram as a dict.
+        """
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+        }
+
+
+class Stats:
+    r"""
+    Collects the durations of the phases of spawning a worker in histograms.
+
+    Durations can be recorded from any thread of the server. Workers cannot
+    record into this object since it lives in the server. They send their
+    durations with a :class:`Report` instead which :meth:`receive` collects
+    in a background thread.
+    """
+
+    def __init__(self):
+        import socket
+
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+        # Workers send their durations as datagrams so that reports of
+        # different workers cannot get mixed up.
+        self._reports, self._sender = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_DGRAM
+        )
+
+    def record(self, phase, seconds):
+        with self._lock:
+            histogram = self._histograms.get(phase)
+            if histogram is None:
+                histogram = self._histograms[phase] = Histogram()
+            histogram.add(seconds)
+
+    def report(self):
+        r"""
+        Return a :class:`Report` for a forked worker.
+        """
+        return Report(self._sender)
+
+    def send(self):
+        r"""
+        Do nothing; the durations recorded in the server are already here.
+        """
+
+    def start(self):
+        r"""
+        Start collecting the durations sent by workers in a background thread.
+        """
+        threading.Thread(target=self.receive, daemon=True).start()
+
+    def receive(self):
+        import marshal
+
+        while True:
+            durations = marshal.loads(self._reports.recv(65536))
+            for phase, seconds in durations:
+                self.record(phase, seconds)
+
+    def summary(self):
+        r"""
+        Return a dict mapping each phase to the statistics of its durations.
+        """
+        with self._lock:
+            return {
+                phase: histogram.summary()
+                for phase, histogram in self._histograms.items()
+            }
+
+    def line(self):
+        r"""
+        Return the median and p99 of all phases as a single line of text.
+        """
+
+        def ms(seconds):
+            return f"{seconds * 1e3:.2f}ms"
+
+        return " ".join(
+            f"{phase}={ms(stats['p50'])}/{ms(stats['p99'])}"
+            for phase, stats in sorted(self.summary().items())
+        )
+
+
+class Report:
+    r"""
+    Collects the durations of phases in a worker until they are sent to the
+    :class:`Stats` of the server with :meth:`send`.
+    """
+
+    def __init__(self, sender):
+        self._sender = sender
+        self._durations = []
+
+    def record(self, phase, seconds):
+        self._durations.append((phase, seconds))
+
+    def report(self):
+        r"""
+        Return a :class:`Report` for a process forked from this one.
+        """
+        return Report(self._sender)
+
+    def send(self):
+        import marshal
+        import socket
+
+        durations, self._durations = self._durations, []
+        if not durations:
+            return
+
+        try:
+            self._sender.send(marshal.dumps(durations), socket.MSG_DONTWAIT)
+        except OSError:
+            # The server is not keeping up or it is gone. Statistics are not
+            # worth waiting for.
+            pass
@@ -0,0 +1,208 @@
+# ********************************************************************
+#  This file is part of forsake
+#
+#        Copyright (C) 2023 Julian Rüth
+#
+#  forsake is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  forsake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with forsake. If not, see <https://www.gnu.org/licenses/>.
+# ********************************************************************
+
+import threading
+
+
+class Stream:
+    r"""
+    Relays stdin, stdout and stderr of a worker over the connection to its
+    ``client`` in a background thread.
+
+    The client sends ``("stdin", data)`` frames, where empty ``data`` closes
+    stdin, and ``("signal", signal)`` frames to signal the worker. It
+    receives ``("stdout", data)`` and ``("stderr", data)`` frames and finally
+    the exit code of the worker once all output has been sent.
+    """
+
+    def __init__(self, client):
+        import os
+        import socket
+
+        from forsake.protocol import Connection
+
+        # The server stops serving the connection once we took it over, so
+        # we need a copy of our own.
+        self._client = Connection.fromfd(client.fileno())
+
+        stdin, self._stdin = os.pipe()
+        self._stdout, stdout = os.pipe()
+        self._stderr, stderr = os.pipe()
+
+        # The ends of the pipes that belong to the worker.
+        self.fds = (stdin, stdout, stderr)
+
+        # Whoever forks the worker reports its PID and exit code to the
+        # reporter as if it were the client. We forward the exit code once
+        # the output of the worker has been relayed.
+        reports, reporter = socket.socketpair()
+        self._reports = Connection(reports)
+        self.reporter = Connection(reporter)
+
+        # Data for the stdin of the worker that it did not read yet.
+        self._pending = b""
+        self._eof = False
+
+        # Whether the client went away.
+        self._gone = False
+
+    def start(self, pid):
+        r"""
+        Start relaying for the worker ``pid`` once it has been forked.
+        """
+        import os
+
+        self.pid = pid
+
+        # Only the worker (and whoever reports its exit code) should hold on
+        # to these so that we notice when they are gone.
+        self.reporter.close()
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = ()
+
+        os.set_blocking(self._stdin, False)
+
+        self._client.send(("return", pid))
+
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        import os
+        import select
+
+        poll = select.poll()
+        poll.register(self._client.fileno(), select.POLLIN)
+        poll.register(self._reports.fileno(), select.POLLIN)
+        poll.register(self._stdout, select.POLLIN)
+        poll.register(self._stderr, select.POLLIN)
+
+        streams = {self._stdout: "stdout", self._stderr: "stderr"}
+        exit = None
+
+        try:
+            while streams or exit is None:
+                for fd, events in poll.poll():
+                    if fd == self._client.fileno():
+                        if not self._receive():
+                            poll.unregister(fd)
+                    elif fd == self._reports.fileno():
+                        try:
+                            kind, value = self._reports.receive()
+                        except EOFError:
+                            # The reaper is gone. There is no exit code.
+                            kind, value = "exit", None
+                        if kind != "return":
+                            exit = (kind, value)
+                            poll.unregister(fd)
+                    elif fd == self._stdin:
+                        self._write()
+                    else:
+                        data = os.read(fd, 1 << 16)
+                        if data:
+                            self._send((streams[fd], data))
+                        else:
+                            poll.unregister(fd)
+                            del streams[fd]
+
+                if self._stdin is not None:
+                    if self._pending:
+                        poll.register(self._stdin, select.POLLOUT)
+                    else:
+                        try:
+                            poll.unregister(self._stdin)
+                        except KeyError:
+                            pass
+
+                        if self._eof:
+                            os.close(self._stdin)
+                            self._stdin = None
+
+            self._send(exit)
+        finally:
+            self.close()
+
+    def _receive(self):
+        r"""
+        Handle a frame from the client and return whether the client is
+        still connected.
+        """
+        import os
+
+        try:
+            kind, value = self._client.receive()
+        except (EOFError, OSError):
+            # Without a client, the worker gets no more input.
+            self._eof = True
+            return False
+
+        if kind == "stdin":
+            if value:
+                self._pending += value
+                self._write()
+            else:
+                self._eof = True
+        elif kind == "signal":
+            try:
+                os.kill(self.pid, value)
+            except ProcessLookupError:
+                pass
+
+        return True
+
+    def _write(self):
+        import os
+
+        if self._stdin is None:
+            self._pending = b""
+            return
+
+        try:
+            written = os.write(self._stdin, self._pending)
+        except BlockingIOError:
+            return
+        except BrokenPipeError:
+            # The worker closed its stdin.
+            written = len(self._pending)
+
+        self._pending = self._pending[written:]
+
+    def _send(self, message):
+        if self._gone:
+            return
+
+        try:
+            self._client.send(message)
+        except OSError:
+            # The client is gone. We still drain the output so that the
+            # worker does not block.
+            self._gone = True
+
+    def close(self):
+        import os
+
+        for fd in (self._stdin, self._stdout, self._stderr, *self.fds):
+            if fd is not None:
+                os.close(fd)
+        self._stdin = self._stdout = self._stderr = None
+        self.fds = ()
+
+        self.reporter.close()
+        self._reports.close()
+        self._client.close()
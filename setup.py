@@ -32,7 +32,9 @@ setup(
     entry_points={
         "console_scripts": [
             "forsake-server=forsake.cli:server",
-            "forsake-client=forsake.cli:client"
+            "forsake-client=forsake.fastclient:main",
+            "forsake-memory=forsake.cli:memory",
+            "forsake-stats=forsake.cli:stats",
         ],
     },
 )
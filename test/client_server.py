@@ -63,9 +63,20 @@ class ClientServer:
         process = context.Process(target=server.start, daemon=False)
         process.server = server
         process.start()
-        yield process
-        process.kill()
-        process.join()
+
+        # Wait for the server to accept connections so clients do not race it.
+        from forsake.activation import listening
+
+        while not listening(socket):
+            import time
+
+            time.sleep(0.001)
+
+        try:
+            yield process
+        finally:
+            process.kill()
+            process.join()
         assert process.exitcode == -9, f"{process.exitcode} != -9"
 
     @contextlib.contextmanager
@@ -0,0 +1,98 @@
+r"""
+Tests driving many forked processes from an asyncio event loop
+"""
+# ********************************************************************
+#  This file is part of forsake
+#
+#        Copyright (C) 2023 Julian Rüth
+#
+#  forsake is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  forsake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with forsake. If not, see <https://www.gnu.org/licenses/>.
+# ********************************************************************
+
+import asyncio
+
+import pytest
+
+import forsake.server
+from forsake.client import AsyncClient
+from forsake.protocol import RemoteError
+
+from .client_server import ClientServer
+
+
+class Server(forsake.server.Server):
+    def __init__(self, socket):
+        super().__init__(socket, concurrency=4)
+
+    def startup(self, args):
+        import os
+        import time
+
+        if args == "sleep":
+            time.sleep(60)
+
+        if args == "fd":
+            os.write(self.fds[0], b"hello")
+            args = 0
+
+        raise SystemExit(args)
+
+
+class TestAsyncClient(ClientServer):
+    def test_many(self, socket):
+        # Many processes can run at the same time from a single thread.
+        async def run():
+            client = AsyncClient(socket)
+            processes = await asyncio.gather(
+                *[client.spawn(exitcode) for exitcode in range(64)]
+            )
+            assert len({process.pid for process in processes}) == 64
+            return await asyncio.gather(*[process.wait() for process in processes])
+
+        with self.spawn_server(socket=socket, server=Server):
+            assert asyncio.run(run()) == list(range(64))
+
+    def test_kill(self, socket):
+        # Processes can be signalled while we wait for them.
+        async def run():
+            process = await AsyncClient(socket).spawn("sleep")
+            process.kill()
+            return await process.wait()
+
+        with self.spawn_server(socket=socket, server=Server):
+            assert asyncio.run(run()) == -9
+
+    def test_fds(self, socket):
+        # File descriptors can be passed to the process.
+        import os
+
+        async def run(fd):
+            process = await AsyncClient(socket).spawn("fd", fds=(fd,))
+            return await process.wait()
+
+        with self.spawn_server(socket=socket, server=Server):
+            read, write = os.pipe()
+            assert asyncio.run(run(write)) == 0
+            os.close(write)
+            assert os.read(read, 5) == b"hello"
+            os.close(read)
+
+    def test_image(self, socket):
+        # Errors of the server are raised on the client.
+        async def run():
+            await AsyncClient(socket, image="missing").spawn()
+
+        with self.spawn_server(socket=socket, server=Server):
+            with pytest.raises(RemoteError):
+                asyncio.run(run())
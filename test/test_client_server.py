@@ -20,6 +20,10 @@ Tests basics of client-server communication
 #  along with forsake. If not, see <https://www.gnu.org/licenses/>.
 # ********************************************************************
 
+import os.path
+
+import pytest
+
 import forsake.server
 import forsake.client
 
@@ -49,12 +53,36 @@ class TestClientServerCommunication(ClientServer):
             with self.spawn_client(socket=socket):
                 pass
 
+    def test_direct_child(self, socket):
+        # The forked process is a child of the server itself. No process
+        # needs to sit in between to wait for it to terminate.
+        from forsake.forker import context
+
+        parents = context.SimpleQueue()
+
+        class Server(forsake.server.Server):
+            def startup(self, _):
+                import os
+
+                parents.put(os.getppid())
+
+        with self.spawn_server(socket=socket, server=Server) as server:
+            with self.spawn_client(socket=socket):
+                pass
+
+            assert parents.get() == server.pid
+
     def test_keyboard_interrupt(self, socket):
         # When C-c is pressed on the client, the forked process receives it.
+        from forsake.forker import context
+
+        # C-c must only be pressed once the forked process can handle it.
+        running = context.Event()
 
         class Server(forsake.server.Server):
             def startup(self, _):
                 try:
+                    running.set()
                     while True:
                         pass
                 except KeyboardInterrupt:
@@ -67,6 +95,7 @@ class TestClientServerCommunication(ClientServer):
                 import signal
                 import os
 
+                running.wait()
                 os.kill(os.getpid(), signal.SIGINT)
 
                 super()._join()
@@ -74,3 +103,691 @@ class TestClientServerCommunication(ClientServer):
         with self.spawn_server(socket=socket, server=Server):
             with self.spawn_client(socket=socket, client=Client, exitcode=42):
                 pass
+
+    def test_pool(self, socket):
+        # With a pool, the forked process has been created before the client
+        # requested it.
+        from forsake.forker import context
+
+        spawned = context.SimpleQueue()
+
+        class Server(forsake.server.Server):
+            def __init__(self, socket):
+                super().__init__(socket, pool=(1, 2))
+                self._spawned = 0
+
+            def spawn(self, client, args):
+                self._spawned += 1
+                return super().spawn(client, args)
+
+            def startup(self, _):
+                spawned.put(self._spawned)
+
+        with self.spawn_server(socket=socket, server=Server):
+            for request in range(1, 4):
+                with self.spawn_client(socket=socket):
+                    pass
+
+                assert spawned.get() < request
+
+    def test_images(self, socket):
+        # Processes can be forked from an image of the server that ran an
+        # additional warmup. Least recently used images are terminated.
+        from functools import partial
+
+        from forsake.forker import context
+
+        spawned = context.SimpleQueue()
+
+        class Server(forsake.server.Server):
+            def __init__(self, socket):
+                super().__init__(socket, max_images=1)
+                self.warmed = None
+
+            def warmup_a(self):
+                self.warmed = "a"
+
+            def warmup_b(self):
+                self.warmed = "b"
+
+            def startup(self, _):
+                import os
+
+                spawned.put((self.warmed, os.getppid()))
+
+        def spawn(image):
+            client = partial(forsake.client.Client, image=image)
+            with self.spawn_client(socket=socket, client=client):
+                pass
+            return spawned.get()
+
+        with self.spawn_server(socket=socket, server=Server) as server:
+            assert spawn(None) == (None, server.pid)
+
+            warm, a = spawn("a")
+            assert warm == "a" and a != server.pid
+            assert spawn("a") == ("a", a)
+
+            warm, b = spawn("b")
+            assert warm == "b" and b not in (a, server.pid)
+
+            # Image "a" was evicted to make room for "b".
+            warm, restarted = spawn("a")
+            assert warm == "a" and restarted != a
+
+            client = partial(forsake.client.Client, image="c")
+            with self.spawn_client(socket=socket, client=client, exitcode=1):
+                pass
+
+    def test_layered_images(self, socket):
+        # An image can be forked from another image so that it only needs to
+        # run the part of the warmup its parent did not already run.
+        from functools import partial
+
+        from forsake.forker import context
+
+        warmed = context.SimpleQueue()
+        spawned = context.SimpleQueue()
+
+        class Server(forsake.server.Server):
+            def __init__(self, socket):
+                super().__init__(socket)
+                self.layers = []
+
+            def warmup_a(self):
+                warmed.put("a")
+                self.layers.append("a")
+
+            def warmup_b(self):
+                warmed.put("b")
+                self.layers.append("b")
+
+            def parent(self, image):
+                return "a" if image == "b" else None
+
+            def startup(self, _):
+                spawned.put(self.layers)
+
+        def spawn(image):
+            client = partial(forsake.client.Client, image=image)
+            with self.spawn_client(socket=socket, client=client):
+                pass
+            return spawned.get()
+
+        with self.spawn_server(socket=socket, server=Server):
+            assert spawn("b") == ["a", "b"]
+            assert spawn("a") == ["a"]
+            assert spawn("b") == ["a", "b"]
+
+            # Each layer of the warmup ran exactly once.
+            assert warmed.get() == "a"
+            assert warmed.get() == "b"
+            assert warmed.empty()
+
+    def test_reload(self, socket, tmp_path):
+        # When a module imported during warmup changes, new processes are
+        # forked from a fresh warmup.
+        import sys
+        import time
+
+        from forsake.forker import context
+
+        module = tmp_path / "reloaded.py"
+        module.write_text("VALUE = 1")
+
+        values = context.SimpleQueue()
+
+        class Server(forsake.server.Server):
+            def __init__(self, socket):
+                super().__init__(socket, reload=True, reload_interval=0.01)
+
+            def warmup(self):
+                sys.path.insert(0, str(tmp_path))
+                import reloaded
+
+            def startup(self, _):
+                import reloaded
+
+                values.put(reloaded.VALUE)
+
+        def spawn():
+            with self.spawn_client(socket=socket):
+                pass
+            return values.get()
+
+        with self.spawn_server(socket=socket, server=Server):
+            assert spawn() == 1
+
+            module.write_text("VALUE = 2")
+            # Make sure that Python does not use the cached bytecode.
+            os.utime(module, (time.time() + 10, time.time() + 10))
+
+            deadline = time.monotonic() + 30
+            while spawn() != 2:
+                assert time.monotonic() < deadline
+
+    def test_admission(self, socket):
+        # With max_workers, requests wait for running workers to terminate.
+        # Once too many requests are waiting, further requests are rejected.
+        import time
+
+        from forsake.forker import context
+
+        release = context.Event()
+
+        class Server(forsake.server.Server):
+            def __init__(self, socket):
+                super().__init__(socket, concurrency=4, max_workers=1, max_queue=1)
+
+            def startup(self, _):
+                release.wait()
+
+        def load():
+            import forsake.rpc
+
+            with forsake.rpc.Client(socket) as server:
+                return server.load()
+
+        with self.spawn_server(socket=socket, server=Server):
+            with self.spawn_client(socket=socket):
+                while load()["running"] != 1:
+                    time.sleep(0.01)
+
+                with self.spawn_client(socket=socket):
+                    while load()["queued"] != 1:
+                        time.sleep(0.01)
+
+                    with self.spawn_client(socket=socket, exitcode=1):
+                        pass
+
+                    release.set()
+
+            assert load() == {
+                "running": 0,
+                "max_workers": 1,
+                "queued": 0,
+                "max_queue": 1,
+            }
+
+    def test_admission_without_concurrency(self, socket):
+        # A server that serves one request at a time rejects requests when
+        # all workers are busy instead of waiting and keeps serving other
+        # requests.
+        import time
+
+        import forsake.rpc
+        from forsake.forker import context
+
+        release = context.Event()
+
+        class Server(forsake.server.Server):
+            def __init__(self, socket):
+                super().__init__(socket, max_workers=1)
+
+            def startup(self, _):
+                release.wait()
+
+        def load():
+            with forsake.rpc.Client(socket) as server:
+                return server.load()
+
+        with self.spawn_server(socket=socket, server=Server):
+            with self.spawn_client(socket=socket):
+                while load()["running"] != 1:
+                    time.sleep(0.01)
+
+                with self.spawn_client(socket=socket, exitcode=1):
+                    pass
+
+                assert load()["queued"] == 0
+
+                release.set()
+
+            with self.spawn_client(socket=socket):
+                pass
+
+    def test_limits(self, socket):
+        # Workers run with resource limits.
+        import resource
+
+        from forsake.forker import context
+
+        limits = context.SimpleQueue()
+
+        class Server(forsake.server.Server):
+            def __init__(self, socket):
+                super().__init__(socket, limits={"cpu": 60})
+
+            def startup(self, _):
+                limits.put(resource.getrlimit(resource.RLIMIT_CPU))
+
+        with self.spawn_server(socket=socket, server=Server):
+            with self.spawn_client(socket=socket):
+                pass
+
+            assert limits.get() == (60, 60)
+
+    @pytest.mark.parametrize("deadline", ["timeout", "cpu_timeout"])
+    def test_deadline(self, socket, deadline):
+        # Workers that exceed their deadline are stopped even if they ignore
+        # SIGINT and SIGTERM. The client learns that the worker timed out.
+        import signal
+        import time
+
+        class Server(forsake.server.Server):
+            def __init__(self, socket):
+                super().__init__(socket, grace=(0.1, 0.1), **{deadline: 0.2})
+
+            def startup(self, _):
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                while True:
+                    pass
+
+        with self.spawn_server(socket=socket, server=Server):
+            start = time.monotonic()
+            with self.spawn_client(socket=socket, exitcode=124):
+                pass
+            assert time.monotonic() - start < 10
+
+    def test_cancel(self, socket):
+        # Anybody can make the server stop a worker.
+        import signal
+
+        import forsake.rpc
+        from forsake.forker import context
+
+        pids = context.SimpleQueue()
+
+        class Server(forsake.server.Server):
+            def __init__(self, socket):
+                super().__init__(socket, grace=(0.1, 0.1))
+
+            def startup(self, _):
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                pids.put(os.getpid())
+                while True:
+                    pass
+
+        with self.spawn_server(socket=socket, server=Server):
+            # The client exits with the exit code of the worker.
+            with self.spawn_client(socket=socket, exitcode=-signal.SIGTERM & 0xFF):
+                with forsake.rpc.Client(socket) as server:
+                    assert server.cancel(pids.get())
+
+            with forsake.rpc.Client(socket) as server:
+                assert not server.cancel(os.getpid())
+
+    def test_idle_timeout(self, socket):
+        # A server stops once no worker ran for a while and removes its
+        # socket so that clients notice.
+        import time
+
+        from forsake.forker import context
+
+        class Server(forsake.server.Server):
+            def __init__(self, socket):
+                super().__init__(socket, idle_timeout=0.1)
+
+            def startup(self, _):
+                time.sleep(0.2)
+
+        server = context.Process(target=Server(socket).start)
+        server.start()
+
+        while not os.path.exists(socket):
+            time.sleep(0.01)
+
+        # The server does not stop while a worker is running.
+        with self.spawn_client(socket=socket):
+            pass
+
+        server.join(timeout=30)
+        assert server.exitcode == 0
+        assert not os.path.exists(socket)
+
+    def test_balancer(self, socket):
+        # The balancer picks the server with the fewest workers.
+        import time
+
+        from forsake.balancer import Balancer
+        from forsake.forker import context
+
+        release = context.Event()
+
+        class Server(forsake.server.Server):
+            def __init__(self, socket):
+                super().__init__(socket, concurrency=2, max_workers=2)
+
+            def startup(self, _):
+                release.wait()
+
+        busy, idle = socket, socket + ".idle"
+
+        with self.spawn_server(socket=busy, server=Server):
+            with self.spawn_server(socket=idle, server=Server):
+                balancer = Balancer([busy, idle, socket + ".missing"])
+                assert balancer.load(idle) == 0
+
+                with self.spawn_client(socket=busy):
+                    while balancer.load(busy) == 0:
+                        time.sleep(0.01)
+
+                    assert {balancer.choose() for _ in range(4)} == {idle}
+
+                    release.set()
+
+                # Servers with the same load take turns.
+                assert {balancer.choose() for _ in range(4)} == {busy, idle}
+
+    def test_balancer_concurrency(self, socket):
+        # The balancer does not keep servers that handle one connection at a
+        # time from serving other clients.
+        from forsake.balancer import Balancer
+
+        class Server(forsake.server.Server):
+            def startup(self, _):
+                pass
+
+        sockets = [socket, socket + ".other"]
+
+        with self.spawn_server(socket=sockets[0], server=Server):
+            with self.spawn_server(socket=sockets[1], server=Server):
+                balancer = Balancer(sockets)
+
+                for _ in range(2):
+                    chosen = balancer.choose()
+                    assert chosen in sockets
+
+                    with self.spawn_client(socket=chosen):
+                        pass
+
+                    for other in sockets:
+                        with self.spawn_client(socket=other):
+                            pass
+
+    @staticmethod
+    def roundtrips(socket, clients):
+        r"""
+        Return how many seconds it took ``clients`` concurrent clients to
+        spawn a process and wait for it and how many seconds all of them
+        took together.
+        """
+        import asyncio
+        import time
+
+        from forsake.client import AsyncClient
+
+        async def roundtrip(client):
+            start = time.monotonic()
+            process = await client.spawn()
+            await process.wait()
+            return time.monotonic() - start
+
+        async def run():
+            client = AsyncClient(socket)
+            return await asyncio.gather(*[roundtrip(client) for _ in range(clients)])
+
+        start = time.monotonic()
+        latencies = asyncio.run(run())
+        return latencies, time.monotonic() - start
+
+    @pytest.mark.parametrize("stalled", [0, 1, 100])
+    def test_concurrency(self, socket, stalled):
+        # A concurrent server serves clients while other clients are still
+        # sending their requests. Spawning is therefore not slowed down by
+        # the number of clients connected.
+        import statistics
+
+        from forsake.protocol import Connection
+
+        class Server(forsake.server.Server):
+            def __init__(self, socket):
+                super().__init__(socket, concurrency=4)
+
+            def startup(self, _):
+                pass
+
+        def latency():
+            return statistics.median(
+                self.roundtrips(socket, 1)[0][0] for _ in range(10)
+            )
+
+        with self.spawn_server(socket=socket, server=Server):
+            baseline = latency()
+
+            connections = [Connection.connect(socket) for _ in range(stalled)]
+            try:
+                for _ in range(3):
+                    with self.spawn_client(socket=socket):
+                        pass
+
+                # Some slack for noisy machines.
+                assert latency() < 3 * baseline + 0.005
+            finally:
+                for connection in connections:
+                    connection.close()
+
+    def test_concurrency_burst(self, socket):
+        # When 100 clients spawn at the same time, forking is serialized but
+        # each spawn costs about as much as when a single client spawns.
+        import statistics
+
+        class Server(forsake.server.Server):
+            def __init__(self, socket):
+                super().__init__(socket, concurrency=4)
+
+            def startup(self, _):
+                pass
+
+        with self.spawn_server(socket=socket, server=Server):
+            baseline = statistics.median(
+                self.roundtrips(socket, 1)[0][0] for _ in range(10)
+            )
+
+            latencies, elapsed = self.roundtrips(socket, 100)
+
+        assert len(latencies) == 100
+        assert elapsed / 100 < 3 * baseline + 0.005
+
+    @pytest.mark.skipif(
+        not os.path.exists("/proc/self/smaps_rollup"),
+        reason="memory usage is only reported on Linux",
+    )
+    def test_memory(self, socket):
+        # The server reports how much memory the forked processes share with it.
+        import forsake.rpc
+        from forsake.forker import context
+
+        running = context.Event()
+        release = context.Event()
+
+        class Server(forsake.server.Server):
+            def __init__(self, socket):
+                super().__init__(socket, freeze=True)
+
+            def startup(self, _):
+                running.set()
+                release.wait()
+
+        with self.spawn_server(socket=socket, server=Server) as server:
+            with self.spawn_client(socket=socket):
+                running.wait()
+
+                with forsake.rpc.Client(socket) as proxy:
+                    report = proxy.memory()
+
+                release.set()
+
+            assert server.pid in report
+            assert len(report) == 2
+
+            for usage in report.values():
+                assert usage["rss"] == usage["shared"] + usage["private"]
+                assert usage["shared"] > 0
+
+    @pytest.mark.skipif(
+        not os.path.exists("/proc/self/smaps"),
+        reason="memory usage is only reported on Linux",
+    )
+    def test_assets(self, socket, tmp_path):
+        # Workers share registered assets with the server.
+        import hashlib
+
+        import forsake.rpc
+        from forsake.forker import context
+
+        running = context.Event()
+        release = context.Event()
+
+        size = 1 << 20
+
+        table = tmp_path / "table.bin"
+        table.write_bytes(b"t" * size)
+
+        class Server(forsake.server.Server):
+            def warmup(self):
+                from forsake.assets import register
+
+                hashlib.sha256(register("data", b"d" * size))
+                hashlib.sha256(register("table", table))
+
+            def startup(self, _):
+                from forsake.assets import get
+
+                assert get("data").readonly
+                assert get("table")[:1] == b"t"
+
+                # Read all pages of the assets.
+                hashlib.sha256(get("data"))
+                hashlib.sha256(get("table"))
+
+                running.set()
+                release.wait()
+
+        with self.spawn_server(socket=socket, server=Server):
+            with self.spawn_client(socket=socket):
+                running.wait()
+
+                with forsake.rpc.Client(socket) as proxy:
+                    report = proxy.assets()
+
+                release.set()
+
+        assert set(report) == {"data", "table"}
+
+        for usage in report.values():
+            assert usage["size"] == size
+            assert usage["rss"] == 2 * size
+            assert usage["saved"] == usage["rss"] - usage["pss"] >= size
+
+    def test_imports(self, socket, tmp_path, monkeypatch):
+        # The server records the modules that workers import and promotes
+        # them into its warmup.
+        import time
+
+        import forsake.rpc
+
+        log = tmp_path / "imported.log"
+        (tmp_path / "forsake_test_promoted.py").write_text(f"""
+import os
+with open({str(log)!r}, "a") as log:
+    log.write(f"{{os.getpid()}}\\n")
+""")
+        monkeypatch.syspath_prepend(str(tmp_path))
+
+        class Server(forsake.server.Server):
+            def __init__(self, socket):
+                super().__init__(socket, promote_imports=2)
+
+            def startup(self, _):
+                import forsake_test_promoted  # noqa: F401
+
+        def imports(spawns):
+            while True:
+                with forsake.rpc.Client(socket) as proxy:
+                    report = proxy.imports().get("forsake_test_promoted")
+                if report is not None and report["spawns"] == spawns:
+                    return report
+                time.sleep(0.01)
+
+        with self.spawn_server(socket=socket, server=Server) as server:
+            for _ in range(2):
+                with self.spawn_client(socket=socket):
+                    pass
+
+            assert imports(2)["count"] == 2
+
+            # The module has been promoted once the server saw the second
+            # import so the next worker does not import it.
+            with self.spawn_client(socket=socket):
+                pass
+
+            assert imports(3)["count"] == 2
+
+        pids = log.read_text().split()
+        assert len(pids) == 3
+        assert str(server.pid) in pids
+
+    def test_stats(self, socket):
+        # The server reports how long the phases of spawning took.
+        import time
+
+        import forsake.rpc
+
+        class Server(forsake.server.Server):
+            def __init__(self, socket):
+                super().__init__(socket, stats=True)
+
+            def startup(self, _):
+                self.record("custom", 1)
+
+        with self.spawn_server(socket=socket, server=Server):
+            with self.spawn_client(socket=socket):
+                pass
+
+            phases = {"decode", "spawn", "fork", "handoff", "custom", "exit"}
+
+            with forsake.rpc.Client(socket) as proxy:
+                # Workers report their durations asynchronously.
+                while not phases.issubset(stats := proxy.stats()):
+                    time.sleep(0.001)
+
+            # Each call to stats() is a request that needs to be decoded.
+            assert stats.pop("decode")["count"] >= 2
+            phases.remove("decode")
+
+            for phase in phases:
+                assert stats[phase]["count"] == 1
+                assert stats[phase]["min"] <= stats[phase]["p50"] <= stats[phase]["max"]
+
+            assert stats["custom"]["sum"] == 1
+
+    def test_xmlrpc_client(self, socket):
+        # Clients that only speak XML-RPC listen on a socket of their own for
+        # the exit code of the forked process.
+        import os.path
+        from tempfile import TemporaryDirectory
+
+        import forsake.rpc
+
+        class Server(forsake.server.Server):
+            def startup(self, _):
+                import sys
+
+                sys.exit(42)
+
+        with self.spawn_server(socket=socket, server=Server):
+            with TemporaryDirectory() as sockdir:
+                callback = os.path.join(sockdir, "socket")
+
+                with forsake.rpc.Server(callback) as server:
+                    exitcodes = []
+                    server.register_function(exitcodes.append, "exit")
+
+                    with forsake.rpc.XMLRPCClient(socket) as remote:
+                        assert remote.spawn(callback, None) > 0
+
+                    server.handle_request()
+
+                    assert exitcodes == [42]
@@ -0,0 +1,111 @@
+r"""
+Tests running functions in forked processes with an executor
+"""
+# ********************************************************************
+#  This file is part of forsake
+#
+#        Copyright (C) 2023 Julian Rüth
+#
+#  forsake is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  forsake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with forsake. If not, see <https://www.gnu.org/licenses/>.
+# ********************************************************************
+
+import os
+
+import pytest
+
+import forsake.server
+from forsake.client import Executor
+from forsake.protocol import RemoteError
+
+from .client_server import ClientServer
+
+
+class Server(forsake.server.PluginServer):
+    def __init__(self, socket):
+        super().__init__(socket, concurrency=4)
+
+    def warmup(self):
+        global WARM
+        WARM = True
+
+
+def warm(x):
+    return (WARM, x, os.getpid())
+
+
+def unpicklable():
+    return lambda: None
+
+
+def buffer(size):
+    import pickle
+
+    return pickle.PickleBuffer(bytearray(b"x" * size))
+
+
+class TestExecutor(ClientServer):
+    def test_map(self, socket):
+        # Each call runs in its own process that has done the warmup.
+        with self.spawn_server(socket=socket, server=Server) as server:
+            with Executor(socket, max_workers=4) as executor:
+                results = list(executor.map(warm, range(8)))
+
+            assert [x for _, x, _ in results] == list(range(8))
+            assert all(warmed for warmed, _, _ in results)
+
+            pids = {pid for _, _, pid in results}
+            assert len(pids) == 8
+            assert server.pid not in pids
+
+    def test_exception(self, socket):
+        # Exceptions are raised on the client.
+        with self.spawn_server(socket=socket, server=Server):
+            with Executor(socket) as executor:
+                with pytest.raises(ValueError):
+                    executor.submit(int, "x").result()
+
+                # Results that cannot be pickled are reported as an error.
+                with pytest.raises(RemoteError):
+                    executor.submit(unpicklable).result()
+
+    def test_exit(self, socket):
+        # A process that terminates without a result is reported as an error.
+        with self.spawn_server(socket=socket, server=Server):
+            with Executor(socket) as executor:
+                with pytest.raises(RemoteError, match="exit code 3"):
+                    executor.submit(os._exit, 3).result()
+
+    def test_timeout(self, socket):
+        # Calls that take too long are stopped by the server.
+        import time
+
+        with self.spawn_server(socket=socket, server=Server):
+            with Executor(socket, timeout=0.1) as executor:
+                with pytest.raises(TimeoutError):
+                    executor.submit(time.sleep, 60).result()
+
+                assert executor.submit(warm, 1).result()[1] == 1
+
+    def test_shared_memory(self, socket):
+        # Large buffers are not copied through the socket but mapped from
+        # shared memory.
+        with self.spawn_server(socket=socket, server=Server):
+            with Executor(socket) as executor:
+                result = executor.submit(buffer, 1 << 20).result()
+
+            assert isinstance(result, memoryview)
+            assert result == b"x" * (1 << 20)
+
+            # The mapping is private to the client.
+            result[0] = ord("y")
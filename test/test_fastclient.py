@@ -0,0 +1,269 @@
+r"""
+Tests the lean ``forsake-client`` command line interface
+"""
+# ********************************************************************
+#  This file is part of forsake
+#
+#        Copyright (C) 2023 Julian Rüth
+#
+#  forsake is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  forsake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with forsake. If not, see <https://www.gnu.org/licenses/>.
+# ********************************************************************
+
+import os.path
+import subprocess
+import sys
+
+import pytest
+
+from forsake.cli import ExecServer
+from forsake.fastclient import main, parse
+from forsake.forker import context
+
+from .client_server import ClientServer
+
+
+# Modules that the client must not import since they take long to import.
+SLOW = [
+    "click",
+    "pickle",
+    "xmlrpc",
+    "http",
+    "socketserver",
+    "tempfile",
+    "threading",
+    "socket",
+    "enum",
+    "forsake.cli",
+    "forsake.rpc",
+    "forsake.server",
+]
+
+# The time in microseconds that importing the client may take.
+BUDGET = 25000
+
+
+def importtime(statement):
+    r"""
+    Return the modules imported by ``statement`` with their cumulative import
+    time in microseconds as reported by ``python -X importtime``.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=root,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    ).stderr
+
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, module = line.split("|")
+        if cumulative.strip().isdigit():
+            modules[module.strip()] = int(cumulative)
+
+    return modules
+
+
+class TestFastClient(ClientServer):
+    def test_imports(self):
+        # The client starts quickly because it does not import anything
+        # that it does not need.
+        modules = importtime("import forsake.fastclient")
+
+        slow = [
+            module
+            for module in modules
+            if any(module == name or module.startswith(name + ".") for name in SLOW)
+        ]
+        assert not slow
+
+        assert modules["forsake.fastclient"] < BUDGET
+
+    def test_parse(self):
+        assert parse(["--socket", "a", "--startup=b"]) == {
+            "--socket": "a",
+            "--startup": "b",
+        }
+
+        with pytest.raises(SystemExit) as e:
+            parse(["--socket", "a"])
+        assert e.value.code == 2
+
+        with pytest.raises(SystemExit) as e:
+            parse(["--socket", "a", "--startup", "b", "--unknown"])
+        assert e.value.code == 2
+
+    def test_exec(self, socket, tmp_path):
+        # The client runs its startup script in a forked process and exits
+        # with its exit code.
+        startup = tmp_path / "startup.py"
+        startup.write_text("import sys; sys.exit(42)")
+
+        with self.spawn_server(socket, server=lambda socket: ExecServer(socket, "")):
+            process = context.Process(
+                target=main, args=(["--socket", socket, "--startup", str(startup)],)
+            )
+            process.start()
+            process.join()
+
+            assert process.exitcode == 42
+
+    def test_script(self, socket, tmp_path):
+        # The client can send the path of its startup script instead. The
+        # server compiles it again only when it changes.
+        startup = tmp_path / "startup.py"
+        startup.write_text("import sys; sys.exit(42)")
+
+        def run():
+            process = context.Process(
+                target=main,
+                args=(["--socket", socket, "--startup", str(startup), "--send=path"],),
+            )
+            process.start()
+            process.join()
+            return process.exitcode
+
+        with self.spawn_server(socket, server=lambda socket: ExecServer(socket, "")):
+            assert run() == 42
+            assert run() == 42
+
+            startup.write_text("import sys; sys.exit(43)")
+            os.utime(startup, ns=(0, 0))
+            assert run() == 43
+
+    @pytest.mark.parametrize("deadline", ["--timeout", "--cpu-timeout"])
+    def test_deadline(self, socket, tmp_path, deadline):
+        # The client can ask the server to stop the process early. It then
+        # exits with the exit code of timeout(1).
+        startup = tmp_path / "startup.py"
+        startup.write_text("while True: pass")
+
+        with self.spawn_server(socket, server=lambda socket: ExecServer(socket, "")):
+            process = context.Process(
+                target=main,
+                args=(
+                    ["--socket", socket, "--startup", str(startup), deadline, "0.2"],
+                ),
+            )
+            process.start()
+            process.join()
+
+            assert process.exitcode == 124
+
+    def test_pty(self, socket, tmp_path):
+        # With --pty the process gets a terminal of its own that the client
+        # relays to its stdin and stdout.
+        startup = tmp_path / "startup.py"
+        startup.write_text(
+            """
+import os, sys
+os.close(os.open("/dev/tty", os.O_RDWR))
+tty = os.isatty(0) and os.isatty(1) and os.isatty(2)
+os.write(1, f"isatty {tty}\\nread {input()}\\n".encode())
+sys.exit(7)
+"""
+        )
+
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+        with self.spawn_server(socket, server=lambda socket: ExecServer(socket, "")):
+            client = subprocess.run(
+                [sys.executable, "-m", "forsake.fastclient"]
+                + ["--socket", socket, "--startup", str(startup), "--pty"],
+                cwd=root,
+                input=b"hello\n",
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                timeout=30,
+            )
+
+        assert client.returncode == 7
+        assert b"isatty True" in client.stdout
+        assert b"read hello" in client.stdout
+
+    def test_activation(self, socket, tmp_path):
+        # Clients start a server when there is none. Only one of several
+        # clients that come at the same time warms up a server.
+        import time
+
+        warmups = tmp_path / "warmups"
+        warmup = tmp_path / "warmup.py"
+        warmup.write_text(f"open({str(warmups)!r}, 'a').write('warm\\n')")
+
+        startup = tmp_path / "startup.py"
+        startup.write_text("import sys; sys.exit(42)")
+
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+        command = [sys.executable, "-m", "forsake.fastclient"]
+        command += ["--socket", socket, "--startup", str(startup)]
+        command += ["--warmup", str(warmup), "--idle-timeout", "0.3"]
+
+        clients = [
+            subprocess.Popen(
+                command,
+                cwd=root,
+                stdin=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            for _ in range(4)
+        ]
+        assert [client.wait(timeout=30) for client in clients] == [42] * 4
+
+        assert warmups.read_text() == "warm\n"
+
+        # The server goes away once it is idle.
+        deadline = time.monotonic() + 30
+        while os.path.exists(socket):
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+    def test_tcp(self, tmp_path):
+        # Over TCP, the server streams stdin, stdout and stderr of the
+        # process over the connection.
+        import socket
+
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            address = "tcp://127.0.0.1:%d" % probe.getsockname()[1]
+
+        startup = tmp_path / "startup.py"
+        startup.write_text(
+            """
+import os, sys
+line = input()
+os.write(1, b"out " + line.encode() + b"\\n")
+os.write(2, b"err " + line.encode() + b"\\n")
+sys.exit(7)
+"""
+        )
+
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+        with self.spawn_server(address, server=lambda socket: ExecServer(socket, "")):
+            client = subprocess.run(
+                [sys.executable, "-m", "forsake.fastclient"]
+                + ["--socket", address, "--startup", str(startup)],
+                cwd=root,
+                input=b"hello\n",
+                capture_output=True,
+                timeout=30,
+            )
+
+        assert client.returncode == 7
+        assert client.stdout == b"out hello\n"
+        assert b"err hello\n" in client.stderr
@@ -21,9 +21,12 @@ Tests the :class:`PluginClient` and :class:`PluginServer` classes
 # ********************************************************************
 
 import os
+import sys
 
 from tempfile import TemporaryDirectory
 
+import pytest
+
 import forsake.server
 import forsake.client
 from forsake.forker import context
@@ -112,6 +115,99 @@ class TestPluginClientServer(ClientServer):
 
             assert env.get()[key] == "1337"
 
+    def test_env_delta(self, socket):
+        r"""
+        Test that a client only sends the differences between its environment
+        and the one of the server and that the forked process ends up with
+        exactly the environment of the client.
+        """
+        env = context.SimpleQueue()
+        sent = context.SimpleQueue()
+
+        class Server(forsake.server.PluginServer):
+            r"""
+            A server that reports its current environment variables.
+            """
+            def startup(self, plugins):
+                super().startup(plugins)
+
+                env.put(dict(os.environ))
+
+        class Client(forsake.client.PluginClient):
+            r"""
+            A client that reports the environment variables it sends.
+            """
+            def start(self, plugins=None):
+                plugins = plugins or {}
+                super().start(plugins={**plugins, **self.collect_env()})
+
+            def _request_fork(self, connection, args, fds=()):
+                sent.put(args["env"])
+                super()._request_fork(connection, args, fds)
+
+        removed = "TEST_PLUGIN_CLIENT_SERVER_REMOVED"
+        added = "TEST_PLUGIN_CLIENT_SERVER_ADDED"
+
+        os.environ[removed] = "1"
+        try:
+            with self.spawn_server(socket=socket, server=Server):
+                del os.environ[removed]
+                os.environ[added] = "1337"
+
+                with self.spawn_client(socket=socket, client=Client):
+                    pass
+
+                del os.environ[added]
+
+                expected = {**os.environ, added: "1337"}
+                changes, _ = sent.get()
+                assert changes == {added: "1337", removed: None}
+                assert env.get() == expected
+        finally:
+            os.environ.pop(removed, None)
+
+    def test_env_image(self, socket):
+        r"""
+        Test that changes to the environment in the warmup of an image do not
+        leak into the environment of the processes forked from it.
+        """
+        from functools import partial
+
+        env = context.SimpleQueue()
+
+        changed = "TEST_PLUGIN_CLIENT_SERVER_CHANGED"
+        added = "TEST_PLUGIN_CLIENT_SERVER_ADDED"
+
+        class Server(forsake.server.PluginServer):
+            r"""
+            A server whose image changes the environment.
+            """
+            def warmup_image(self):
+                os.environ[changed] = "image"
+                os.environ[added] = "image"
+
+            def startup(self, plugins):
+                super().startup(plugins)
+
+                env.put(dict(os.environ))
+
+        class Client(forsake.client.PluginClient):
+            def start(self, plugins=None):
+                plugins = plugins or {}
+                super().start(plugins={**plugins, **self.collect_env()})
+
+        os.environ[changed] = "1"
+        try:
+            with self.spawn_server(socket=socket, server=Server):
+                with self.spawn_client(
+                    socket=socket, client=partial(Client, image="image")
+                ):
+                    pass
+
+                assert env.get() == dict(os.environ)
+        finally:
+            os.environ.pop(changed, None)
+
     def test_stdio(self, socket, capfd):
         r"""
         Test that the client's stdin, stdout, stderr are connected to the
@@ -141,3 +237,47 @@ class TestPluginClientServer(ClientServer):
 
         captured = capfd.readouterr()
         assert captured.out == "Hello World!\n"
+
+    @pytest.mark.parametrize("pool", [None, (0, 1)], ids=["fork", "pool"])
+    def test_stdio_pipe(self, socket, capfd, pool):
+        r"""
+        Test that the forked process can be part of a pipeline, i.e., that it
+        reads from the client's stdin when that is a pipe.
+        """
+        read, write = os.pipe()
+        os.write(write, b"hello world\n")
+        os.close(write)
+
+        class Server(forsake.server.PluginServer):
+            r"""
+            A server that copies its stdin to stdout in upper case.
+            """
+
+            def __init__(self, socket):
+                super().__init__(socket, pool=pool)
+
+            def startup(self, plugins):
+                super().startup(plugins)
+
+                print(sys.stdin.read().upper(), end="", flush=True)
+
+        class Client(forsake.client.PluginClient):
+            r"""
+            A client whose stdin is the pipe.
+            """
+
+            def start(self, plugins=None):
+                os.dup2(read, 0)
+                sys.stdin = open(0, "r", closefd=False)
+
+                plugins = plugins or {}
+                super().start(plugins={**plugins, **self.collect_stdio()})
+
+        with self.spawn_server(socket=socket, server=Server):
+            with self.spawn_client(socket=socket, client=Client):
+                pass
+
+        os.close(read)
+
+        captured = capfd.readouterr()
+        assert captured.out == "HELLO WORLD\n"
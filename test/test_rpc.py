@@ -0,0 +1,82 @@
+r"""
+Tests the binary and the XML-RPC transport of :mod:`forsake.rpc`
+"""
+
+# ********************************************************************
+#  This file is part of forsake
+#
+#        Copyright (C) 2023 Julian Rüth
+#
+#  forsake is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  forsake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with forsake. If not, see <https://www.gnu.org/licenses/>.
+# ********************************************************************
+
+import xmlrpc.client
+
+import pytest
+
+import forsake.rpc
+from forsake.protocol import RemoteError
+
+from .client_server import ClientServer
+
+
+class EchoServer:
+    r"""
+    A server that echoes its arguments back to the client.
+    """
+
+    def __init__(self, socket):
+        self._socket = socket
+
+    def start(self):
+        with forsake.rpc.Server(self._socket) as server:
+            server.register_function(lambda *args: args, "echo")
+            server.register_function(lambda: 1 / 0, "fail")
+
+            server.serve_forever()
+
+
+class TestRPC(ClientServer):
+    @pytest.mark.parametrize(
+        "client",
+        [forsake.rpc.Client, forsake.rpc.XMLRPCClient],
+        ids=["binary", "xmlrpc"],
+    )
+    def test_echo(self, socket, client):
+        r"""
+        Test that both transports can talk to the same server.
+        """
+        with self.spawn_server(socket=socket, server=EchoServer):
+            with client(socket) as remote:
+                assert list(remote.echo(None, 1337, "x", b"\0" * 1024)) == [
+                    None,
+                    1337,
+                    "x",
+                    b"\0" * 1024,
+                ]
+                # The connection can be used for more than one request.
+                assert list(remote.echo()) == []
+
+    def test_fault(self, socket):
+        r"""
+        Test that exceptions on the server are reported to the client.
+        """
+        with self.spawn_server(socket=socket, server=EchoServer):
+            with forsake.rpc.Client(socket) as remote:
+                with pytest.raises(RemoteError, match="ZeroDivisionError"):
+                    remote.fail()
+
+            with forsake.rpc.XMLRPCClient(socket) as remote:
+                with pytest.raises(xmlrpc.client.Fault, match="ZeroDivisionError"):
+                    remote.fail()